@@ -3,34 +3,37 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import sys
-from os import environ
-from os.path import realpath, join, dirname, abspath
-from argparse import ArgumentParser, SUPPRESS
-from logging import debug, basicConfig, DEBUG, WARNING
-from xml.etree import ElementTree
-from typing import Tuple, Optional, cast
+if __name__ == '__main__':
+    # Installed as /usr/bin/obex-capabilities, a symlink to this file. Import
+    # the package from its parent directory in place of the script directory
+    # instead of running this module twice or widening sys.path.
+    import sys
+    from os.path import realpath, dirname
+    sys.path[0] = dirname(dirname(realpath(__file__)))
+    from obex_capabilities import main
+    sys.exit(main())
 
-# Add topdir to import path
-topdir = realpath(join(dirname(__file__) + "/.."))  # noqa
-sys.path.insert(0, topdir)  # noqa
-sys.path.insert(0, '/lib')
+import sys
+from time import monotonic
+from types import SimpleNamespace
 
-from obex_capabilities.device import Device, guess_device
-from obex_capabilities.modem import Modem, guess_modem
+from obex_capabilities.log import setup, debug
+from obex_capabilities.device import Device, DeviceSnapshot, guess_device
+from obex_capabilities.modem import Modem, NetworkSnapshot, guess_modem, \
+    parse_backends
+from obex_capabilities.cache import load_capabilities, store_capabilities, \
+    load_tiers, known_fields, snapshot_tiers
+from obex_capabilities.daemon import request_capabilities, serve
+from obex_capabilities.threads import in_thread
 
 VERSION = '0.1.1'
-XML_TEMPLATE = 'data/template.xml'
-XML_TEMPLATE = """<?xml version="1.0"?>
-<!DOCTYPE Capability SYSTEM "obex-capability.dtd">
-<Capability Version="1.0">
+# Rendered with str.format(), the layout matches what ElementTree.indent()
+# produced for the original template
+XML_TEMPLATE = """<Capability Version="1.0">
  <General>
-  <Manufacturer></Manufacturer>
-  <Model></Model>
-  <SN></SN>
-  <SW version=""/>
-  <OS version="" id=""/>
- </General>
+{manufacturer}{model}{unique_id}  <SW version="{software_version}" />
+  <OS version="{os_version}" id="{codename}" />
+{network} </General>
  <Service>
   <UUID>SYNCML-SYNC</UUID>
   <Name>SyncML</Name>
@@ -44,66 +47,246 @@ XML_TEMPLATE = """<?xml version="1.0"?>
   </Object>
  </Service>
 </Capability>"""
+XML_NETWORK_TEMPLATE = """  <Ext>
+   <XNam>NetworkInfo</XNam>
+   <XVal>CurrentNetwork={network}</XVal>
+   <XVal>CountryCode={mcc}</XVal>
+   <XVal>NetworkID={mnc}</XVal>
+  </Ext>
+"""
+XML_TEXT_ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;'
+})
+XML_ATTRIBUTE_ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    '\r': '&#13;',
+    '\n': '&#10;',
+    '\t': '&#09;'
+})
+
+def text_element(tag: str, text: str | None) -> str:
+    """
+    Render an indented General child, empty elements are self-closing.
+    """
+    if not text:
+        return f'  <{tag} />\n'
+    return f'  <{tag}>{text.translate(XML_TEXT_ESCAPES)}</{tag}>\n'
 
-def generate_capabilities(device: Device, modem: Optional[Modem]):
-    tree = ElementTree.ElementTree(ElementTree.fromstring(XML_TEMPLATE))
-    root = tree.getroot()
+def attribute(value: str | None) -> str:
+    return value.translate(XML_ATTRIBUTE_ESCAPES) if value is not None else ''
 
+def generate_capabilities(device: DeviceSnapshot, modem: Modem | None) -> str:
     debug('Generating capabilities')
+    debug(str(device))
+
+    # Modem information, offline modems have no network to advertise
+    network = ''
+    if modem is not None and modem.network is not None:
+        network = XML_NETWORK_TEMPLATE.format(
+            network=str(modem.network).translate(XML_TEXT_ESCAPES),
+            mcc=str(modem.mcc).translate(XML_TEXT_ESCAPES),
+            mnc=str(modem.mnc).translate(XML_TEXT_ESCAPES))
 
     # Device and OS information
-    manufacturer = root.findall('./General/Manufacturer')[0]
-    model = root.findall('./General/Model')[0]
-    unique_id = root.findall('./General/SN')[0]
-    software = root.findall('./General/SW')[0]
-    os = root.findall('./General/OS')[0]
-
-    manufacturer.text = device.manufacturer if device.manufacturer is not None else ""
-    model.text = device.model if device.model is not None else ""
-    unique_id.text = device.unique_id if device.unique_id is not None else ""
-    software.set('version', device.software_version if device.software_version is not None else "")
-    os.set('version', device.os_version if device.os_version is not None else "")
-    os.set('id', device.codename if device.codename is not None else "")
-
-    # Modem information
-    if modem is not None:
-        general = root.findall('./General')[0]
-        ext = ElementTree.SubElement(general, 'Ext')
-        xnam = ElementTree.SubElement(ext, 'XNam')
-        xnam.text = 'NetworkInfo'
-        current_network = ElementTree.SubElement(ext, 'XVal')
-        current_network.text = f'CurrentNetwork={modem.network}'
-        country_code = ElementTree.SubElement(ext, 'XVal')
-        country_code.text = f'CountryCode={modem.mcc}'
-        modem_id = ElementTree.SubElement(ext, 'XVal')
-        modem_id.text = f'NetworkID={modem.mnc}'
-
-    debug('Generation complete, serializing XML')
-
-    # Pretty print to stdout for obexd
-    ElementTree.indent(tree, space=' ')
-    capabilities = ElementTree.tostring(root).decode()
-    print(capabilities)
+    capabilities = XML_TEMPLATE.format(
+        manufacturer=text_element('Manufacturer', device.manufacturer),
+        model=text_element('Model', device.model),
+        unique_id=text_element('SN', device.unique_id),
+        software_version=attribute(device.software_version),
+        os_version=attribute(device.os_version),
+        codename=attribute(device.codename),
+        network=network)
+
+    debug('Generation complete')
+
+    # obexd gets US-ASCII with character references, like ElementTree emits
+    return capabilities.encode('ascii', 'xmlcharrefreplace').decode()
+
+DEFAULT_OPTIONS = {
+    'debug': False,
+    'test': False,
+    'no_cache': False,
+    'daemon': False,
+    'allow_activation': None,
+    'backend': None,
+    'deadline_ms': None
+}
+# Share of the --deadline-ms budget spent waiting for the modem, the rest is
+# left for reading the device information
+MODEM_BUDGET_SHARE = 0.6
+
+def parse_args(argv: list):
+    # obexd never passes flags, don't pay for importing argparse then
+    if not argv:
+        return SimpleNamespace(**DEFAULT_OPTIONS)
+
+    from argparse import ArgumentParser, ArgumentTypeError
+
+    def backends(value: str) -> list:
+        try:
+            return parse_backends(value)
+        except ValueError as e:
+            raise ArgumentTypeError(str(e))
+
+    def milliseconds(value: str) -> int:
+        try:
+            value = int(value)
+        except ValueError:
+            raise ArgumentTypeError(f'invalid number of milliseconds: {value}')
+        if value <= 0:
+            raise ArgumentTypeError(f'deadline must be positive: {value}')
+        return value
 
-def main():
-    # Parse arguments
     parser = ArgumentParser(description='Generator tool for OBEX capabilities')
     parser.add_argument('--debug', help='Enable logging to stderr',
                         dest='debug', action='store_true')
-    parser.set_defaults(debug=False, test=False)
-    args = parser.parse_args()
+    parser.add_argument('--no-cache', help='Do not use or update the capability cache',
+                        dest='no_cache', action='store_true')
+    parser.add_argument('--daemon', help='Serve capabilities over a Unix socket',
+                        dest='daemon', action='store_true')
+    parser.add_argument('--allow-activation',
+                        help='Start modem services through D-Bus activation',
+                        dest='allow_activation', action='store_true')
+    parser.add_argument('--backend',
+                        help='Modem backends to use in order of preference: '
+                             'ofono, mm, a comma separated list or none',
+                        dest='backend', type=backends)
+    parser.add_argument('--deadline-ms', help='Time limit for generating capabilities',
+                        dest='deadline_ms', type=milliseconds)
+    parser.set_defaults(**DEFAULT_OPTIONS)
+    return parser.parse_args(argv)
+
+def generate_device(pending_modem, use_cache: bool, tiers: dict,
+                    deadline: float | None = None) -> tuple:
+    """
+    Generate capabilities from the device and the modem still being probed
+    by pending_modem, or the network tier if there is none. Returns the
+    capabilities and the tiers they were generated from.
+    """
+    modem = None
+    if pending_modem is None and tiers['network'] is not None:
+        debug('Using cached network information')
+        modem = NetworkSnapshot(*tiers['network'])
+
+    device: Device = guess_device(use_plan=use_cache)
+    snapshot = device.snapshot(pending_modem, known_fields(tiers), deadline)
+    if pending_modem is not None:
+        modem = device.modem
+    return generate_capabilities(snapshot, modem), snapshot_tiers(snapshot, modem, tiers)
+
+def generate(allow_activation: bool | None, backends: list | None,
+             use_cache: bool, tiers: dict) -> tuple:
+    """
+    Generate capabilities, reusing the fresh cache tiers. Returns the
+    capabilities and the tiers they were generated from.
+    """
+    pending_modem = None
+    if 'network' not in tiers:
+        # The device information is read while the modem is probed
+        pending_modem = in_thread(lambda: guess_modem(allow_activation=allow_activation,
+                                                      use_cache=use_cache,
+                                                      backends=backends))
+    return generate_device(pending_modem, use_cache, tiers)
+
+def generate_within(budget: float, allow_activation: bool | None,
+                    backends: list | None, use_cache: bool, tiers: dict) -> tuple:
+    """
+    Generate capabilities within budget seconds. When the modem does not
+    answer in time, the last cached capabilities are used, or capabilities
+    without network information if there are none. Returns the
+    capabilities, the tiers they were generated from and whether they are
+    complete.
+    """
+    deadline = monotonic() + budget
+    complete = True
+
+    def cached_capabilities() -> str | None:
+        # Only the default backends fill the cache
+        if not use_cache or backends is not None:
+            return None
+        return load_capabilities(validate=False)
+
+    pending_modem = None
+    if 'network' not in tiers:
+        pending_modem = in_thread(lambda: guess_modem(budget * MODEM_BUDGET_SHARE,
+                                                      allow_activation,
+                                                      use_cache=use_cache,
+                                                      backends=backends))
+
+    # The device information is read while the modem is probed
+    future = in_thread(lambda: generate_device(pending_modem, use_cache, tiers,
+                                               deadline))
+    if pending_modem is not None:
+        try:
+            pending_modem.result(timeout=max(0.0, deadline - monotonic()))
+        except TimeoutError:
+            debug('Out of time while probing the modem')
+            capabilities = cached_capabilities()
+            if capabilities is not None:
+                return capabilities, None, False
+            complete = False
+
+    try:
+        return (*future.result(timeout=max(0.0, deadline - monotonic())), complete)
+    except TimeoutError:
+        debug('Out of time while reading the device information')
+        capabilities = cached_capabilities()
+        if capabilities is not None:
+            return capabilities, None, False
+
+    # Nothing to fall back to, better late than nothing
+    return (*future.result(), complete)
+
+def main():
+    # Parse arguments
+    args = parse_args(sys.argv[1:])
 
     # Configure logging
-    lvl = WARNING
-    if args.debug:
-        lvl = DEBUG
-    basicConfig(level=lvl)
+    setup(args.debug)
 
-    modem: Modem = guess_modem()
-    device: Device = guess_device(modem)
+    if args.daemon:
+        serve(args.allow_activation, args.backend)
+        return
 
-    # Generate capabilities
-    generate_capabilities(device, modem)
+    # Ask the daemon first, it already has everything in memory. It probes
+    # with its own options, so not if this run asks for others.
+    if args.backend is None and not args.no_cache and not args.allow_activation:
+        capabilities = request_capabilities()
+        if capabilities is not None:
+            debug('Using capabilities from daemon')
+            print(capabilities)
+            return
 
-if __name__ == '__main__':
-    main()
+    # The cache holds what the default backends found, runs pinning others
+    # neither use nor replace it
+    cache_capabilities = not args.no_cache and args.backend is None
+
+    # Nothing changed since the last run, skip D-Bus entirely
+    tiers = {}
+    if cache_capabilities:
+        tiers = load_tiers()
+        if 'capabilities' in tiers:
+            debug('Using cached capabilities')
+            print(tiers['capabilities'])
+            return
+
+    # Generate capabilities and pretty print to stdout for obexd, only the
+    # stale tiers are read again
+    if args.deadline_ms is not None:
+        capabilities, tiers, complete = generate_within(args.deadline_ms / 1000,
+                                                        args.allow_activation,
+                                                        args.backend,
+                                                        not args.no_cache, tiers)
+    else:
+        (capabilities, tiers), complete = \
+            generate(args.allow_activation, args.backend, not args.no_cache, tiers), True
+    print(capabilities)
+
+    # Don't let a fallback replace complete capabilities in the cache
+    if complete and cache_capabilities:
+        store_capabilities(capabilities, tiers)
@@ -0,0 +1,254 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import marshal
+from os import environ, stat, replace, makedirs, getpid, unlink, \
+    open as os_open, write, close, O_WRONLY, O_CREAT, O_EXCL
+from os.path import join, expanduser
+from time import time
+from zlib import crc32
+
+from .log import debug
+
+RUNTIME_DIR = join(environ.get('XDG_RUNTIME_DIR', '/run'), 'obex-capabilities')
+STATE_DIR = 'obex-capabilities'
+CACHE_FILE = 'capabilities.cache'
+CACHE_MAGIC = b'OBEXCAP1'
+# Tiers of the capability cache and the device fields of each. The device
+# tier lives until the package or rootfs changes, the OS tier until
+# os-release does and the network tier for NETWORK_CACHE_TTL seconds or
+# until a modem service starts.
+CACHE_TIERS = ('device', 'os', 'network')
+DEVICE_TIER_FIELDS = ('manufacturer', 'model', 'codename', 'unique_id')
+OS_TIER_FIELDS = ('software_version', 'os_version')
+NETWORK_CACHE_TTL = 60
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+def runtime_dir() -> str:
+    """
+    Directory holding the runtime state, $XDG_RUNTIME_DIR for user services.
+    """
+    return environ.get('CACHE_DIR', RUNTIME_DIR)
+
+def state_dir() -> str:
+    """
+    Directory holding the state kept across boots, shared by the daemon and
+    the command run by obexd: $XDG_STATE_HOME/obex-capabilities, which is
+    also the StateDirectory= of the user service.
+    """
+    state_home = environ.get('XDG_STATE_HOME') or \
+        join(environ.get('HOME') or expanduser('~'), '.local', 'state')
+    return join(state_home, STATE_DIR)
+
+def read_checked(path: str) -> bytes | None:
+    """
+    Read a file written by write_atomic(), None if missing or corrupted.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    header, _, payload = data.partition(b'\n')
+    if header != CACHE_MAGIC + b' %08x' % crc32(payload):
+        debug(f'Ignoring corrupted cache file {path}')
+        return None
+
+    return payload
+
+def write_atomic(path: str, payload: bytes, mode: int = 0o600):
+    """
+    Write a checksummed file, readers either see the old or the new content.
+    """
+    directory = path.rpartition('/')[0]
+    makedirs(directory, mode=0o700, exist_ok=True)
+
+    tmp = f'{path}.{getpid()}.tmp'
+    fd = os_open(tmp, O_WRONLY | O_CREAT | O_EXCL, mode)
+    try:
+        write(fd, CACHE_MAGIC + b' %08x\n' % crc32(payload) + payload)
+    finally:
+        close(fd)
+
+    try:
+        replace(tmp, path)
+    except OSError:
+        unlink(tmp)
+        raise
+
+def stamp(path: str) -> list | None:
+    """
+    Identify the current version of a file without reading it.
+    """
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+def cached_stamp(path: str, stamps: dict) -> list | None:
+    """
+    Stamp of a file, taken once per resolution.
+    """
+    if path not in stamps:
+        stamps[path] = stamp(path)
+    return stamps[path]
+
+def modem_fingerprint() -> str | None:
+    """
+    Modem state cannot be observed without D-Bus, the network tier is tied
+    to the current boot and expires after network_ttl() seconds instead.
+    """
+    try:
+        with open(BOOT_ID_PATH) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def network_stamps() -> tuple:
+    """
+    Stamps of the network tier: the boot and the invocation of every modem
+    backend service, so starting one of them expires it.
+    """
+    # modem.py stores its state through this module
+    from .modem import backend_invocations
+    return modem_fingerprint(), backend_invocations()
+
+def network_ttl() -> float:
+    return float(environ.get('NETWORK_CACHE_TTL', NETWORK_CACHE_TTL))
+
+def device_stamps() -> dict:
+    """
+    Stamps of every input the device tier is resolved from: this package
+    and the files of the rootfs describing the device.
+    """
+    # device.py reads build.prop through this module
+    from .device import MACHINE_ID_PATH, IMEI_FILE, \
+        DROIDIAN_OVERRIDE_MANUFACTURER, DROIDIAN_OVERRIDE_MODEL, \
+        DROIDIAN_OVERRIDE_CODENAME
+    from .props import PROP_FILES
+    from .devicetree import device_tree_root, DEVICE_TREE_COMPATIBLE, \
+        DEVICE_TREE_MODEL
+
+    paths = [
+        __file__,
+        environ.get('MACHINE_ID_PATH', MACHINE_ID_PATH),
+        join(state_dir(), IMEI_FILE),
+        join(device_tree_root(), DEVICE_TREE_COMPATIBLE),
+        join(device_tree_root(), DEVICE_TREE_MODEL),
+        DROIDIAN_OVERRIDE_MANUFACTURER,
+        DROIDIAN_OVERRIDE_MODEL,
+        DROIDIAN_OVERRIDE_CODENAME
+    ] + PROP_FILES
+
+    return {path: stamp(path) for path in paths}
+
+def os_stamps() -> dict:
+    """
+    Stamps of the os-release files the OS tier is read from.
+    """
+    from .osrelease import os_release_paths
+    return {path: stamp(path) for path in os_release_paths()}
+
+def load_cache() -> dict | None:
+    payload = read_checked(join(runtime_dir(), CACHE_FILE))
+    if payload is None:
+        return None
+
+    try:
+        cache = marshal.loads(payload)
+    except (ValueError, EOFError, TypeError):
+        return None
+    if not isinstance(cache, dict) or not all(tier in cache for tier in CACHE_TIERS):
+        return None
+    return cache
+
+def load_tiers() -> dict:
+    """
+    Values of the cache tiers that are still fresh, keyed by tier. If every
+    tier is, the capabilities generated from them are under 'capabilities'.
+    """
+    cache = load_cache()
+    if cache is None:
+        return {}
+
+    tiers = {}
+    stamps, values = cache['device']
+    if stamps == device_stamps():
+        tiers['device'] = values
+    else:
+        debug('Device cache tier is stale')
+
+    stamps, values = cache['os']
+    if stamps == os_stamps():
+        tiers['os'] = values
+    else:
+        debug('OS cache tier is stale')
+
+    (stamps, created), values = cache['network']
+    if stamps == network_stamps() and 0 <= time() - created <= network_ttl():
+        tiers['network'] = values
+        tiers['network_created'] = created
+    else:
+        debug('Network cache tier expired')
+
+    if all(tier in tiers for tier in CACHE_TIERS):
+        tiers['capabilities'] = cache['capabilities']
+    return tiers
+
+def known_fields(tiers: dict) -> dict:
+    """
+    Device fields provided by the fresh tiers, by name.
+    """
+    fields = {}
+    if 'device' in tiers:
+        fields.update(zip(DEVICE_TIER_FIELDS, tiers['device']))
+    if 'os' in tiers:
+        fields.update(zip(OS_TIER_FIELDS, tiers['os']))
+    return fields
+
+def snapshot_tiers(device, modem, tiers: dict) -> dict:
+    """
+    Tier values of a device snapshot and modem. The network tier keeps its
+    age if it came from tiers.
+    """
+    network = None
+    if modem is not None and modem.network is not None:
+        network = (str(modem.network), str(modem.mcc), str(modem.mnc))
+
+    return {
+        'device': tuple(getattr(device, field) for field in DEVICE_TIER_FIELDS),
+        'os': tuple(getattr(device, field) for field in OS_TIER_FIELDS),
+        'network': network,
+        'network_created': tiers.get('network_created', time())
+    }
+
+def load_capabilities(validate: bool = True) -> str | None:
+    """
+    Return the cached capabilities if every tier is fresh, or whatever was
+    cached last if validate is False.
+    """
+    if validate:
+        return load_tiers().get('capabilities')
+
+    cache = load_cache()
+    return cache['capabilities'] if cache is not None else None
+
+def store_capabilities(capabilities: str, tiers: dict):
+    """
+    Cache the generated capabilities and the tiers they were generated
+    from, failures are not fatal.
+    """
+    path = join(runtime_dir(), CACHE_FILE)
+    cache = {
+        'device': (device_stamps(), tiers['device']),
+        'os': (os_stamps(), tiers['os']),
+        'network': ((network_stamps(), tiers['network_created']),
+                    tiers['network']),
+        'capabilities': capabilities
+    }
+
+    try:
+        write_atomic(path, marshal.dumps(cache))
+    except OSError as e:
+        debug(f'Unable to write capability cache: {e}')
@@ -0,0 +1,184 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from os import chmod, unlink, makedirs
+from os.path import join
+# The socket module drags in enum and selectors, the client only needs the
+# bare C socket type
+from _socket import socket as client_socket, AF_UNIX, SOCK_STREAM
+
+from .log import debug
+from .cache import runtime_dir
+from .device import DeviceSnapshot, guess_device
+from .modem import Modem, guess_modem, watch_modems
+from .threads import in_thread
+
+SOCKET_FILE = 'capabilities.sock'
+CONNECT_TIMEOUT = 0.005
+# The daemon answers from memory and never blocks its main loop on D-Bus
+READ_TIMEOUT = 0.01
+
+def socket_path() -> str:
+    return join(runtime_dir(), SOCKET_FILE)
+
+def request_capabilities() -> str | None:
+    """
+    Fetch the capabilities from a running daemon, None if it is not reachable.
+    """
+    client = client_socket(AF_UNIX, SOCK_STREAM)
+    try:
+        client.settimeout(CONNECT_TIMEOUT)
+        client.connect(socket_path())
+        client.settimeout(READ_TIMEOUT)
+
+        chunks = []
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except OSError as e:
+        debug(f'Capability daemon not reachable: {e}')
+        return None
+    finally:
+        client.close()
+
+    return b''.join(chunks).decode() if chunks else None
+
+class CapabilityDaemon:
+    """
+    Keep the device, modem and rendered capabilities in memory and hand them
+    out over a Unix socket. Modem changes arrive as D-Bus signals, so serving
+    a request does not talk to D-Bus at all. Modems are probed in a thread,
+    requests are answered with what was found before meanwhile.
+    """
+
+    def __init__(self, allow_activation: bool | None = None,
+                 backends: list | None = None):
+        self._allow_activation: bool | None = allow_activation
+        self._backends: list | None = backends
+        self._modem: Modem | None = None
+        self._device: DeviceSnapshot | None = None
+        self._capabilities: bytes = b''
+        self._stale: bool = True
+        # Future of the probe in progress and whether to probe again after it
+        self._probing = None
+        self._reload_pending: bool = False
+        self._matches: list = watch_modems(self.reload)
+        self.reload()
+
+    def reload(self):
+        """
+        Probe the modem again in a thread, used when modems come and go. The
+        result is taken over on the main loop.
+        """
+        from gi.repository import GLib  # type: ignore
+
+        if self._probing is not None:
+            # The probe in progress may have missed the change
+            self._reload_pending = True
+            return
+
+        debug('Reloading modem')
+        self._probing = in_thread(self._probe, 'reload')
+        self._probing.add_done_callback(lambda _: GLib.idle_add(self._probed))
+
+    def _probe(self) -> tuple:
+        try:
+            # Reloads follow modems appearing, never trust the negative cache
+            modem = guess_modem(allow_activation=self._allow_activation,
+                                use_cache=False, backends=self._backends)
+        except TimeoutError:
+            modem = None
+        return modem, guess_device(modem).snapshot()
+
+    def _probed(self) -> bool:
+        future, self._probing = self._probing, None
+        try:
+            modem, device = future.result()
+        except Exception as e:
+            debug(f'Unable to reload modem: {e}')
+        else:
+            if self._modem is not None:
+                self._modem.unwatch()
+            self._modem, self._device = modem, device
+            if modem is not None:
+                modem.watch(self._modem_changed)
+            self._stale = True
+
+        if self._reload_pending:
+            self._reload_pending = False
+            self.reload()
+        return False
+
+    def _modem_changed(self):
+        self._stale = True
+
+    def capabilities(self) -> bytes | None:
+        """
+        The rendered capabilities, None until the first probe is done.
+        """
+        # Imported here, the package imports this module on start up
+        from obex_capabilities import generate_capabilities
+
+        if self._device is None:
+            return None
+        if self._stale:
+            self._capabilities = \
+                generate_capabilities(self._device, self._modem).encode()
+            self._stale = False
+
+        return self._capabilities
+
+    def _accept(self, server) -> bool:
+        connection, _ = server.accept()
+        with connection:
+            try:
+                # Closing without an answer lets the client generate them
+                capabilities = self.capabilities()
+                if capabilities is not None:
+                    connection.sendall(capabilities)
+            except Exception as e:
+                # Clients fall back to generating them on their own
+                debug(f'Unable to send capabilities: {e}')
+        return True
+
+    def serve(self):
+        from signal import SIGHUP, SIGTERM
+        from socket import socket
+        from gi.repository import GLib  # type: ignore
+
+        path = socket_path()
+        server = socket(AF_UNIX, SOCK_STREAM)
+
+        makedirs(runtime_dir(), mode=0o700, exist_ok=True)
+        try:
+            unlink(path)
+        except FileNotFoundError:
+            pass
+
+        loop = GLib.MainLoop()
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, SIGHUP,
+                             lambda: self.reload() or True)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, SIGTERM,
+                             lambda: loop.quit() or False)
+
+        try:
+            server.bind(path)
+            chmod(path, 0o600)
+            server.listen()
+            GLib.io_add_watch(server.fileno(), GLib.PRIORITY_DEFAULT,
+                              GLib.IO_IN, lambda *_: self._accept(server))
+            debug(f'Serving capabilities on {path}')
+            loop.run()
+        finally:
+            server.close()
+            unlink(path)
+
+def serve(allow_activation: bool | None = None, backends: list | None = None):
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init  # type: ignore
+
+    # Signals are dispatched from the GLib main loop of serve(), modems are
+    # probed from other threads
+    threads_init()
+    DBusGMainLoop(set_as_default=True)
+    CapabilityDaemon(allow_activation, backends).serve()
@@ -2,29 +2,52 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from os.path import exists
-from os import environ, path
+import marshal
+from time import monotonic
+from os.path import exists, join
+from os import environ, scandir
 from abc import ABC, abstractmethod
-from logging import debug, critical
-from typing import cast
+from .log import debug, critical
 from .modem import Modem
+from .cache import state_dir, read_checked, write_atomic, stamp, cached_stamp
+from .props import partition_files, prop_guards, read_props, file_props, \
+    prop_source
+from .osrelease import os_release
+from .devicetree import device_tree, device_tree_root, DEVICE_TREE_COMPATIBLE, \
+    DEVICE_TREE_MODEL
 
-OS_RELEASE_PATH = '/etc/os-release'
 MACHINE_ID_PATH = '/etc/machine-id'
-DEVICE_TREE_COMPATIBLE = '/proc/device-tree/compatible'
-DEVICE_TREE_MODEL = '/proc/device-tree/model'
-
-class Device(ABC):
+DROIDIAN_OVERRIDE_DIR = '/usr/lib/droidian/device'
+DROIDIAN_OVERRIDE_PREFIX = 'obex-'
+DROIDIAN_OVERRIDE_MANUFACTURER = join(DROIDIAN_OVERRIDE_DIR, 'obex-manufacturer')
+DROIDIAN_OVERRIDE_MODEL = join(DROIDIAN_OVERRIDE_DIR, 'obex-model')
+DROIDIAN_OVERRIDE_CODENAME = join(DROIDIAN_OVERRIDE_DIR, 'obex-codename')
+# Fields a device can override, obex-<field> in DROIDIAN_OVERRIDE_DIR
+OVERRIDE_FIELDS = ('manufacturer', 'model', 'codename')
+PLAN_FILE = 'device.plan'
+IMEI_FILE = 'imei'
+
+class DeviceSnapshot:
     """
-    Represent the information about a device.
+    The information about a device, resolved once and immutable afterwards
+    so it can be shared between threads.
     """
+    __slots__ = ('manufacturer', 'model', 'codename', 'unique_id',
+                 'software_version', 'os_version')
 
-    def __init__(self, modem=None):
-        self._os_release: str = None
-        self._unique_id: str = None
-        self._modem: Modem = modem
-        self._os_release_path = environ.get('OS_RELEASE_PATH', OS_RELEASE_PATH)
-        self._machine_id_path = environ.get('MACHINE_ID_PATH', MACHINE_ID_PATH)
+    def __init__(self, manufacturer: str | None, model: str | None,
+                 codename: str | None, unique_id: str | None,
+                 software_version: str | None, os_version: str | None):
+        for name, value in zip(self.__slots__,
+                               (manufacturer, model, codename, unique_id,
+                                software_version, os_version)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
 
     def __repr__(self):
         return 'DEVICE' \
@@ -38,22 +61,56 @@ class Device(ABC):
     def __str__(self):
         return self.__repr__()
 
-    def _read_os_release(self) -> str:
+class Device(ABC):
+    """
+    Represent the information about a device.
+    """
+
+    def __init__(self, modem=None):
+        self._unique_id: str = None
+        self._modem: Modem = modem
+        self._machine_id_path = environ.get('MACHINE_ID_PATH', MACHINE_ID_PATH)
+
+    def __repr__(self):
+        return self.snapshot().__repr__()
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def modem(self) -> Modem | None:
+        return self._modem
+
+    def snapshot(self, pending_modem=None, known: dict | None = None,
+                 deadline: float | None = None) -> DeviceSnapshot:
         """
-        Read /etc/os-release to determine OS version
+        Resolve every field once. The properties read their sources again on
+        every access. With pending_modem, a Future of the modem still being
+        probed, only unique_id waits for it, until the monotonic deadline if
+        given; a modem that timed out counts as none. Fields in known are
+        taken as they are, except unique_id if a modem reports its IMEI.
         """
-        # Determine OS release only once
-        if self._os_release is not None:
-            return self._os_release
+        if known is None:
+            known = {}
+
+        def field(name: str):
+            return known[name] if name in known else getattr(self, name)
 
-        with open(self._os_release_path) as f:
-            for line in filter(lambda line: '=' in line, f.readlines()):
-                key, value = line.split('=')
-                if key.lower() == 'version_id':
-                    self._os_release = value.strip().replace('"', '')
-                    break
+        manufacturer, model, codename = \
+            field('manufacturer'), field('model'), field('codename')
+        software_version, os_version = field('software_version'), field('os_version')
 
-        return self._os_release
+        if pending_modem is not None:
+            try:
+                timeout = None if deadline is None else max(0.0, deadline - monotonic())
+                self._modem = pending_modem.result(timeout=timeout)
+            except TimeoutError:
+                self._modem = None
+            self._unique_id = None
+
+        unique_id = field('unique_id') if self._modem is None else self.unique_id
+        return DeviceSnapshot(manufacturer, model, codename, unique_id,
+                              software_version, os_version)
 
     @property
     @abstractmethod
@@ -86,10 +143,22 @@ class Device(ABC):
             return self._unique_id
 
         if self._modem is not None:
-            debug('Found modem, using IMEI')
-            self._unique_id = cast(str, self._modem.imei)
+            imei = self._modem.imei
+            if imei:
+                debug('Found modem, using IMEI')
+                self._unique_id = imei
+                if load_imei() != (self._modem.identity, imei):
+                    store_imei(self._modem.identity, imei)
+                return self._unique_id
+            debug('Modem does not report its IMEI')
+
+        # The modem is not always up yet, stick to the IMEI it reported before
+        stored = load_imei()
+        if stored is not None:
+            debug('No IMEI available, using stored IMEI')
+            self._unique_id = stored[1]
         else:
-            debug('No modem available, using machine-id')
+            debug('No IMEI available, using machine-id')
             with open(self._machine_id_path) as f:
                 self._unique_id = f.read().strip()
 
@@ -100,100 +169,271 @@ class Device(ABC):
         """
         Software version release number.
         """
-        return self._read_os_release()
+        return os_release().get('VERSION_ID')
 
     @property
     def os_version(self) -> str:
         """
         OS version release number.
         """
-        return self._read_os_release()
+        return os_release().get('VERSION_ID')
 
 class ARMDevice(Device):
-    def __init__(self, modem=None):
+    def __init__(self, modem=None, overrides: dict | None = None,
+                 use_plan: bool = True):
         super().__init__(modem)
+        self._overrides: dict | None = overrides
+        self._use_plan: bool = use_plan
+        self._plan: dict | None = None
+        self._plan_changed: bool = False
+        # Stamps taken while resolving, path -> stamp
+        self._stamps: dict = {}
+        # build.prop file of each partition, looked up once when needed
+        self._prop_files: list | None = None
+
+    def snapshot(self, pending_modem=None, known: dict | None = None,
+                 deadline: float | None = None) -> DeviceSnapshot:
+        snapshot = super().snapshot(pending_modem, known, deadline)
+        if self._plan_changed and self._use_plan:
+            store_plan(self._plan)
+            self._plan_changed = False
+        return snapshot
+
+    def _resolve(self, field: str) -> str | None:
+        """
+        Value of a field, read straight from the source that provided it last
+        time unless that source or one taking precedence over it changed
+        since.
+        """
+        if self._plan is None:
+            self._plan = load_plan() if self._use_plan else new_plan()
+
+        entry = self._plan['fields'].get(field)
+        if entry is not None:
+            value = follow_plan(entry, self._stamps)
+            if value:
+                return value
+            debug(f'Resolution plan of {field} is stale')
+
+        if self._overrides is None:
+            self._overrides = read_overrides()
+        if self._prop_files is None:
+            self._prop_files = partition_files(self._stamps)
+        value, entry = walk_sources(field, self._overrides, self._prop_files,
+                                    self._stamps)
+        if entry is not None:
+            self._plan['fields'][field] = entry
+            self._plan_changed = True
+        return value
 
     @property
     def manufacturer(self) -> str:
-        if path.exists("/usr/lib/droidian/device/obex-manufacturer"):
-            with open("/usr/lib/droidian/device/obex-manufacturer", "r") as manufacturer_file:
-                return manufacturer_file.read().strip()
-
-        try:
-            manufacturer = extract_prop('ro.product.vendor.manufacturer')
-            return manufacturer
-        except Exception:
-            pass
-
-        with open(DEVICE_TREE_COMPATIBLE) as f:
-            compatible = f.read().split('\x00')
-            manufacturer, _ = compatible[0].split(',')
-            return manufacturer
+        return self._resolve('manufacturer')
 
     @property
     def model(self) -> str:
-        if path.exists("/usr/lib/droidian/device/obex-model"):
-            with open("/usr/lib/droidian/device/obex-model", "r") as model_file:
-                return model_file.read().strip()
+        return self._resolve('model')
 
+    @property
+    def codename(self) -> str:
+        return self._resolve('codename')
+
+def read_overrides() -> dict:
+    """
+    Every obex-* override shipped by the device adaptation, read in a single
+    pass over DROIDIAN_OVERRIDE_DIR and keyed by field name.
+    """
+    overrides = {}
+    try:
+        with scandir(DROIDIAN_OVERRIDE_DIR) as entries:
+            for entry in entries:
+                if not entry.name.startswith(DROIDIAN_OVERRIDE_PREFIX):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    with open(entry.path) as f:
+                        value = f.read().strip()
+                except OSError as e:
+                    debug(f'Skipping override {entry.path}: {e}')
+                    continue
+                overrides[entry.name[len(DROIDIAN_OVERRIDE_PREFIX):]] = value
+    except OSError:
+        pass
+
+    return overrides
+
+def product_props(name: str) -> list:
+    """
+    The ro.product properties describing the device. The system partition
+    is a generic image on Halium devices, so its values are not used.
+    """
+    return [f'ro.product.vendor.{name}', f'ro.product.odm.{name}',
+            f'ro.product.{name}']
+
+# Android properties and device tree attribute and file of every field
+FIELD_SOURCES = {
+    'manufacturer': (product_props('manufacturer'), 'vendor', DEVICE_TREE_COMPATIBLE),
+    'model': (product_props('model'), 'model', DEVICE_TREE_MODEL),
+    'codename': (['ro.product.board'] + product_props('device'), 'board',
+                 DEVICE_TREE_COMPATIBLE)
+}
+
+def find_prop(props: list, files: list) -> tuple:
+    """
+    Name and value of the first of the given Android properties that is set.
+    The live property area is preferred, the build.prop files from
+    partition_files() are only read without it.
+    """
+    # Only needed when it comes to reading properties
+    from .propertyarea import get_property
+
+    android_props = None
+    for prop in props:
+        value = get_property(prop)
+        if not value:
+            if android_props is None:
+                android_props = read_props(files)
+            value = android_props.get(prop)
+        if value:
+            return prop, value
+    return None, None
+
+def override_path(field: str) -> str:
+    return join(DROIDIAN_OVERRIDE_DIR, DROIDIAN_OVERRIDE_PREFIX + field)
+
+def walk_sources(field: str, overrides: dict, prop_files: list,
+                 stamps: dict) -> tuple:
+    """
+    Resolve a field through the whole chain of sources: override, Android
+    properties from prop_files, device tree. Returns the value and the
+    resolution plan entry of the source that provided it, if it can be
+    validated later. Entries also hold the stamps of the override and the
+    prop_guards() of the build.prop files, including missing ones, so they
+    are dropped once a file taking precedence appears or changes.
+    """
+    if field in overrides:
+        path = override_path(field)
+        return overrides[field], \
+            ('override', field, path, cached_stamp(path, stamps), {})
+
+    # An override or build.prop appearing or changing may take precedence
+    path = override_path(field)
+    guards = {path: cached_stamp(path, stamps), **prop_guards(prop_files, stamps)}
+
+    props, tree_attribute, tree_file = FIELD_SOURCES[field]
+    try:
+        prop, value = find_prop(props, prop_files)
+        if value:
+            source = prop_source(prop, prop_files)
+            if source is None:
+                return value, None
+            return value, ('property', prop, *source, guards)
+    except Exception:
+        pass
+
+    value = getattr(device_tree(), tree_attribute)
+    if not value:
+        return value, None
+    path = join(device_tree_root(), tree_file)
+    return value, ('devicetree', tree_attribute, path,
+                   cached_stamp(path, stamps), guards)
+
+def follow_plan(entry: tuple, stamps: dict) -> str | None:
+    """
+    Value of a field from the source recorded in its plan entry, None if the
+    source or a file taking precedence over it changed, or the source no
+    longer provides it.
+    """
+    try:
+        source, name, path, source_stamp, guards = entry
+    except (TypeError, ValueError):
+        return None
+
+    if cached_stamp(path, stamps) != source_stamp:
+        return None
+    for guard, guard_stamp in guards.items():
+        if cached_stamp(guard, stamps) != guard_stamp:
+            return None
+
+    if source == 'override':
         try:
-            model = extract_prop('ro.product.vendor.model')
-            return model
-        except Exception:
-            pass
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
 
-        with open(DEVICE_TREE_MODEL) as f:
-            model = f.read().split('\x00')[0]
-            return model
+    if source == 'property':
+        # Only needed when it comes to reading properties
+        from .propertyarea import get_property
+        return get_property(name) or file_props(path, source_stamp).get(name)
 
-    @property
-    def codename(self) -> str:
-        if path.exists("/usr/lib/droidian/device/obex-codename"):
-            with open("/usr/lib/droidian/device/obex-codename", "r") as codename_file:
-                return codename_file.read().strip()
+    if source == 'devicetree':
+        if path.rpartition('/')[0] != device_tree_root():
+            return None
+        return getattr(device_tree(), name)
+
+    return None
 
+def load_plan() -> dict:
+    """
+    The resolution plan of the last run, discarded when overrides were added
+    or removed since.
+    """
+    override_stamp = stamp(DROIDIAN_OVERRIDE_DIR)
+    payload = read_checked(join(state_dir(), PLAN_FILE))
+    if payload is not None:
         try:
-            codename = extract_prop('ro.product.board')
-            if codename is not None:
-                return codename
-
-            codename = extract_prop('ro.product.vendor.device')
-            if codename is not None:
-                return codename
-        except Exception:
+            plan = marshal.loads(payload)
+            if plan['overrides'] == override_stamp:
+                return plan
+        except (ValueError, EOFError, TypeError, KeyError):
             pass
 
-        with open(DEVICE_TREE_COMPATIBLE) as f:
-            compatible = f.read().split('\x00')
-            _, codename = compatible[0].split(',')
-            return codename
-
-def extract_prop(prop):
-    prop_files = [
-        '/var/lib/lxc/android/rootfs/vendor/build.prop',
-        '/android/vendor/build.prop',
-        '/vendor/build.prop'
-    ]
-
-    prop_file = None
-    for file in prop_files:
-        if exists(file):
-            prop_file = file
-            break
-
-    if prop_file is None:
+    return new_plan(override_stamp)
+
+def new_plan(override_stamp: list | None = None) -> dict:
+    return {'overrides': override_stamp, 'fields': {}}
+
+def store_plan(plan: dict):
+    try:
+        write_atomic(join(state_dir(), PLAN_FILE), marshal.dumps(plan))
+    except OSError as e:
+        debug(f'Unable to write resolution plan: {e}')
+
+def load_imei() -> tuple | None:
+    """
+    Identity and IMEI of the last modem seen, None if there never was one.
+    """
+    payload = read_checked(join(state_dir(), IMEI_FILE))
+    if payload is None:
         return None
 
-    with open(prop_file, 'r') as f:
-        for line in f:
-            if line.startswith(prop):
-                return line.split('=')[1].strip()
-    return None
+    try:
+        return tuple(marshal.loads(payload))
+    except (ValueError, EOFError, TypeError):
+        return None
 
-def guess_device(modem=None):
-    if exists(DEVICE_TREE_COMPATIBLE):
+def store_imei(identity: str, imei: str):
+    """
+    Remember the IMEI of a modem, readable by its owner only.
+    """
+    debug(f'Storing IMEI of {identity}')
+    try:
+        write_atomic(join(state_dir(), IMEI_FILE), marshal.dumps((identity, imei)),
+                     mode=0o600)
+    except OSError as e:
+        debug(f'Unable to store IMEI: {e}')
+
+def guess_device(modem=None, use_plan: bool = True):
+    if exists(join(device_tree_root(), DEVICE_TREE_COMPATIBLE)):
         debug("Device is ARM")
-        return ARMDevice(modem)
+        return ARMDevice(modem, use_plan=use_plan)
+
+    overrides = read_overrides()
+    if all(field in overrides for field in OVERRIDE_FIELDS):
+        debug("Device is fully overridden")
+        return ARMDevice(modem, overrides, use_plan)
     else:
         critical("Device not implemented!")
         return
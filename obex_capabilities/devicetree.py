@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from os import environ
+from os.path import exists, join
+
+DEVICE_TREE_PATH = '/proc/device-tree'
+DEVICE_TREE_FALLBACK_PATH = '/sys/firmware/devicetree/base'
+DEVICE_TREE_COMPATIBLE = 'compatible'
+DEVICE_TREE_MODEL = 'model'
+
+# Parsed device trees of this process, root -> DeviceTree
+_device_trees: dict = {}
+
+def device_tree_root() -> str:
+    """
+    Directory of the device tree, DEVICE_TREE_PATH overrides the default.
+    """
+    root = environ.get('DEVICE_TREE_PATH')
+    if root is not None:
+        return root
+    if not exists(DEVICE_TREE_PATH) and exists(DEVICE_TREE_FALLBACK_PATH):
+        return DEVICE_TREE_FALLBACK_PATH
+    return DEVICE_TREE_PATH
+
+def read_strings(path: str) -> list:
+    """
+    Read a device tree property holding a list of strings.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    return [s.decode(errors='replace') for s in data.split(b'\x00') if s]
+
+class DeviceTree:
+    """
+    The compatible and model properties of the device tree root node.
+    """
+
+    def __init__(self, root: str):
+        # Every compatible entry, most specific first
+        self.compatible: tuple = tuple(read_strings(join(root, DEVICE_TREE_COMPATIBLE)))
+        # (vendor, board) of every "vendor,board" compatible entry
+        self.pairs: tuple = tuple(tuple(entry.split(',', 1))
+                                  for entry in self.compatible if ',' in entry)
+        model = read_strings(join(root, DEVICE_TREE_MODEL))
+        self.model: str | None = model[0] if model else None
+
+    @property
+    def vendor(self) -> str | None:
+        return self.pairs[0][0] if self.pairs else None
+
+    @property
+    def board(self) -> str | None:
+        return self.pairs[0][1] if self.pairs else None
+
+def device_tree(root: str | None = None) -> DeviceTree:
+    """
+    The device tree at root, read once per process.
+    """
+    if root is None:
+        root = device_tree_root()
+
+    tree = _device_trees.get(root)
+    if tree is None:
+        tree = _device_trees[root] = DeviceTree(root)
+    return tree
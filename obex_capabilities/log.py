@@ -0,0 +1,26 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# logging pulls in re, traceback and friends, which costs more than the rest
+# of a cached run. It is only imported once something is actually logged.
+
+_debug: bool = False
+
+def setup(debug: bool):
+    """
+    Log everything to stderr with --debug, warnings and above otherwise.
+    """
+    global _debug
+    _debug = debug
+    if debug:
+        from logging import basicConfig, DEBUG
+        basicConfig(level=DEBUG)
+
+def debug(msg: str):
+    if _debug:
+        from logging import debug
+        debug(msg)
+
+def critical(msg: str):
+    from logging import basicConfig, critical, WARNING
+    basicConfig(level=WARNING)
+    critical(msg)
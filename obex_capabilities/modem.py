@@ -2,31 +2,103 @@
 # Copyright (C) 2024 Bardia Moshiri <fakeshell@bardia.tech>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import marshal
 from abc import ABC, abstractmethod
-from typing import Optional
-from logging import debug
-
-from dbus import SystemBus, Interface  # type: ignore
+from os import environ, readlink, unlink
+from os.path import join
+from time import monotonic, time
+from .log import debug
+from .cache import runtime_dir, state_dir, read_checked, write_atomic, \
+    modem_fingerprint
+from .osrelease import read_env_file
+from .threads import in_thread
 
+FREEDESKTOP_NAME = 'org.freedesktop.DBus'
+FREEDESKTOP_OBJECT_PATH = '/org/freedesktop/DBus'
+FREEDESKTOP_INTERFACE_DBUS = 'org.freedesktop.DBus'
+FREEDESKTOP_METHOD_LIST_NAMES = 'ListNames'
+FREEDESKTOP_METHOD_LIST_ACTIVATABLE_NAMES = 'ListActivatableNames'
 FREEDESKTOP_INTERFACE_PROPERTIES = 'org.freedesktop.DBus.Properties'
 FREEDESKTOP_INTERFACE_OBJECT_MANAGER = 'org.freedesktop.DBus.ObjectManager'
 FREEDESKTOP_METHOD_GET_MANAGED_OBJECTS = 'GetManagedObjects'
+FREEDESKTOP_SIGNAL_PROPERTIES_CHANGED = 'PropertiesChanged'
+FREEDESKTOP_SIGNAL_INTERFACES_ADDED = 'InterfacesAdded'
+FREEDESKTOP_SIGNAL_INTERFACES_REMOVED = 'InterfacesRemoved'
 MM_NAME = 'org.freedesktop.ModemManager1'
 MM_OBJECT_PATH = '/org/freedesktop/ModemManager1'
+MM_INTERFACE_MODEM = 'org.freedesktop.ModemManager1.Modem'
 MM_INTERFACE_LOCATION = 'org.freedesktop.ModemManager1.Modem.Location'
 MM_METHOD_GET_LOCATION = 'GetLocation'
 MM_INTERFACE_MODEM_3GPP = 'org.freedesktop.ModemManager1.Modem.Modem3gpp'
-MM_METHOD_GET = 'Get'
 MM_LOCATION_3GPP = 1
 OFONO_NAME = 'org.ofono'
 OFONO_OBJECT_PATH = '/'
 OFONO_INTERFACE_MANAGER = 'org.ofono.Manager'
 OFONO_METHOD_GET_MODEMS = 'GetModems'
+OFONO_SIGNAL_MODEM_ADDED = 'ModemAdded'
+OFONO_SIGNAL_MODEM_REMOVED = 'ModemRemoved'
+OFONO_SIGNAL_PROPERTY_CHANGED = 'PropertyChanged'
 OFONO_INTERFACE_NETWORK_REGISTRATION = 'org.ofono.NetworkRegistration'
 OFONO_METHOD_GET_PROPERTIES = 'GetProperties'
 OFONO_INTERFACE_MODEM = 'org.ofono.Modem'
+PROBE_TIMEOUT = 5.0
+OFONO_UNIT = 'ofono.service'
+MM_UNIT = 'ModemManager.service'
+SYSTEMD_UNITS_PATH = '/run/systemd/units'
+NO_MODEM_CACHE_FILE = 'no-modem.cache'
+NO_MODEM_CACHE_TTL = 30
+CONFIG_PATH = '/etc/obex-capabilities.conf'
+CONFIG_BACKEND = 'BACKEND'
+BACKEND_STATE_FILE = 'backend'
+
+# One connection shared by every backend, created on first use
+_bus = None
+_messages: int = 0
+_messages_lock = None
+
+def system_bus():
+    """
+    The process wide system bus connection.
+    """
+    global _bus, _messages_lock
+    if _bus is None:
+        # Imported here so cached runs never load dbus-python
+        from threading import Lock
+        from dbus import SystemBus  # type: ignore
+        _messages_lock = Lock()
+        _bus = SystemBus()
+    return _bus
+
+def call(bus_name: str, object_path: str, interface: str, method: str,
+         timeout: float = PROBE_TIMEOUT):
+    """
+    Call a D-Bus method without arguments. Unlike proxy objects, this neither
+    introspects the object nor resolves the owner of the bus name first, so
+    every call is exactly one message.
+    """
+    global _messages
+    bus = system_bus()
+    with _messages_lock:
+        _messages += 1
+    return bus.call_blocking(bus_name, object_path, interface, method,
+                             '', (), timeout=timeout)
+
+def message_count() -> int:
+    """
+    Number of D-Bus method calls made by this process.
+    """
+    return _messages
+
+def split_operator_code(operator_code: str) -> tuple:
+    """
+    Split a 3GPP operator code into its 3 digit MCC and 2 or 3 digit MNC.
+    """
+    return operator_code[:3], operator_code[3:]
 
 class Modem(ABC):
+    def __init__(self):
+        self._matches: list = []
+
     def __repr__(self):
         return f'NETWORK ({self.__class__.__name__})' \
             f'\n  Modem: {self.network}' \
@@ -44,6 +116,13 @@ class Modem(ABC):
         """
         raise NotImplementedError("Modem IMEI getter not implemented")
 
+    @property
+    def identity(self) -> str:
+        """
+        Identifier of the modem hardware, stable across boots.
+        """
+        return f'{self.__class__.__name__}:{self.imei}'
+
     @abstractmethod
     def network(self) -> str:
         """
@@ -67,44 +146,123 @@ class Modem(ABC):
         """
         raise NotImplementedError("Modem ID MNC getter not implemented")
 
+    @abstractmethod
+    def watch(self, callback):
+        """
+        Keep the network information current from D-Bus signals and call
+        callback after every change. Requires a D-Bus main loop.
+        """
+        raise NotImplementedError("Modem watcher not implemented")
+
+    def unwatch(self):
+        """
+        Stop listening to the signals subscribed to by watch().
+        """
+        for match in self._matches:
+            match.remove()
+        self._matches = []
+
+class NetworkSnapshot:
+    """
+    Network information of a modem as it was cached, without the modem.
+    """
+    __slots__ = ('network', 'mcc', 'mnc')
+
+    def __init__(self, network: str | None, mcc: str | None, mnc: str | None):
+        for name, value in zip(self.__slots__, (network, mcc, mnc)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __repr__(self):
+        return 'NETWORK (cached)' \
+            f'\n  Modem: {self.network}' \
+            f'\n  MCC: {self.mcc}' \
+            f'\n  MNC: {self.mnc}'
+
 class Ofono(Modem):
     """
     Ofono backend to retrieve network information.
     """
-    def __init__(self):
+    BUS_NAME = OFONO_NAME
+    UNIT = OFONO_UNIT
+
+    def __init__(self, timeout: float = PROBE_TIMEOUT):
         super().__init__()
-        self._dbus: SystemBus = SystemBus()
-
-        # Get exposed Modem objects
-        o = self._dbus.get_object(OFONO_NAME, OFONO_OBJECT_PATH)
-        self._object_manager_interface: Interface = \
-            Interface(o, OFONO_INTERFACE_MANAGER)
-        modems = self._object_manager_interface\
-            .get_dbus_method(OFONO_METHOD_GET_MODEMS)
-
-        if modems:
-            # Execute DBus method to get modems and use the first one
-            object_path: str = list(dict(modems()).keys())[0]
-            debug(f'Found oFono modem: {object_path}')
-            o = self._dbus.get_object(OFONO_NAME, object_path)
-
-            # Init DBus oFono NetworkRegistration and Modem interfaces
-            self._network_registration_interface: Interface = \
-                Interface(o, OFONO_INTERFACE_NETWORK_REGISTRATION)
-            self._modem_interface: Interface = \
-                Interface(o, OFONO_INTERFACE_MODEM)
-
-            # Get IMEI, network and location information
-            props: dict = {}
-            props = self._network_registration_interface.GetProperties()
-            self._mcc: str = props['MobileCountryCode']
-            self._mnc: str = props['MobileNetworkCode']
-            self._network: str = props['Name']
-            props = self._modem_interface.GetProperties()
-            self._imei: str = props['Serial']
-        else:
+
+        # Modems come with their properties, including IMEI and interfaces
+        modem_list: list = call(OFONO_NAME, OFONO_OBJECT_PATH,
+                                OFONO_INTERFACE_MANAGER,
+                                OFONO_METHOD_GET_MODEMS, timeout)
+        if not modem_list:
             raise RuntimeError('Unable to find oFono modem')
 
+        object_path, props = modem_list[0]
+        debug(f'Found oFono modem: {object_path} '
+              f'(powered: {bool(props.get("Powered"))}, '
+              f'online: {bool(props.get("Online"))})')
+        self._object_path: str = str(object_path)
+        self._timeout: float = timeout
+
+        if 'Serial' not in props:
+            raise RuntimeError('oFono modem does not report its IMEI')
+        self._imei: str = str(props['Serial'])
+        self._network: str | None = None
+        self._mcc: str | None = None
+        self._mnc: str | None = None
+
+        # Offline modems have no NetworkRegistration, don't ask for it then
+        if OFONO_INTERFACE_NETWORK_REGISTRATION in props.get('Interfaces', []):
+            self._read_network_registration()
+
+    def _read_network_registration(self):
+        props: dict = call(OFONO_NAME, self._object_path,
+                           OFONO_INTERFACE_NETWORK_REGISTRATION,
+                           OFONO_METHOD_GET_PROPERTIES, self._timeout)
+        self._network = str(props['Name']) if 'Name' in props else None
+        self._mcc = str(props.get('MobileCountryCode', ''))
+        self._mnc = str(props.get('MobileNetworkCode', ''))
+
+    def watch(self, callback):
+        def network_registration_changed(name, value):
+            if name == 'Name':
+                self._network = str(value)
+            elif name == 'MobileCountryCode':
+                self._mcc = str(value)
+            elif name == 'MobileNetworkCode':
+                self._mnc = str(value)
+            else:
+                return
+            debug(f'oFono network registration changed: {name}={value}')
+            callback()
+
+        def modem_changed(name, value):
+            if name != 'Interfaces':
+                return
+            if OFONO_INTERFACE_NETWORK_REGISTRATION in value:
+                if self._network is None:
+                    try:
+                        self._read_network_registration()
+                    except Exception as e:
+                        debug(f'Unable to read oFono network registration: {e}')
+            else:
+                self._network = self._mcc = self._mnc = None
+            callback()
+
+        self._matches.append(system_bus().add_signal_receiver(
+            network_registration_changed,
+            signal_name=OFONO_SIGNAL_PROPERTY_CHANGED,
+            dbus_interface=OFONO_INTERFACE_NETWORK_REGISTRATION,
+            bus_name=OFONO_NAME,
+            path=self._object_path))
+        self._matches.append(system_bus().add_signal_receiver(
+            modem_changed,
+            signal_name=OFONO_SIGNAL_PROPERTY_CHANGED,
+            dbus_interface=OFONO_INTERFACE_MODEM,
+            bus_name=OFONO_NAME,
+            path=self._object_path))
+
     @property
     def imei(self) -> str:
         return self._imei
@@ -125,47 +283,79 @@ class ModemManager(Modem):
     """
     ModemManager backend to retrieve network information.
     """
-    def __init__(self):
+    BUS_NAME = MM_NAME
+    UNIT = MM_UNIT
+
+    def __init__(self, timeout: float = PROBE_TIMEOUT):
         super().__init__()
-        self._dbus: SystemBus = SystemBus()
-
-        # Get exposed Modem objects
-        o = self._dbus.get_object(MM_NAME, MM_OBJECT_PATH)
-        self._object_manager_interface: Interface = \
-            Interface(o, FREEDESKTOP_INTERFACE_OBJECT_MANAGER)
-        modems = self._object_manager_interface\
-            .get_dbus_method(FREEDESKTOP_METHOD_GET_MANAGED_OBJECTS)
-
-        if modems:
-            # Execute DBus method to get modems and use the first one
-            object_path: str = list(modems().keys())[0]
-            debug(f'Found ModemManager modem: {object_path}')
-            o = self._dbus.get_object(MM_NAME, object_path)
-
-            # Init DBus MM 3GPP and Location interfaces
-            self._location_interface: Interface = \
-                Interface(o, MM_INTERFACE_LOCATION)
-            self._3gpp_interface: Interface = \
-                Interface(o, MM_INTERFACE_MODEM_3GPP)
-
-            # Get IMEI, network and location information
-            self._imei: str = self._3gpp_interface\
-                .Get(MM_INTERFACE_MODEM_3GPP, 'Imei',
-                     dbus_interface=FREEDESKTOP_INTERFACE_PROPERTIES)
-            self._network: str = self._3gpp_interface\
-                .Get(MM_INTERFACE_MODEM_3GPP, 'OperatorName',
-                     dbus_interface=FREEDESKTOP_INTERFACE_PROPERTIES)
-            location: dict = self._location_interface\
-                .get_dbus_method(MM_METHOD_GET_LOCATION)
-            location_3gpp: str = location()[MM_LOCATION_3GPP]
-            self._mcc, self._mnc, _, _, _ = location_3gpp.split(',')
+
+        # Every property of every modem arrives in this one reply
+        managed_objects: dict = call(MM_NAME, MM_OBJECT_PATH,
+                                     FREEDESKTOP_INTERFACE_OBJECT_MANAGER,
+                                     FREEDESKTOP_METHOD_GET_MANAGED_OBJECTS,
+                                     timeout)
+        for object_path, interfaces in managed_objects.items():
+            if MM_INTERFACE_MODEM_3GPP in interfaces:
+                break
         else:
             raise RuntimeError('Unable to find ModemManager modem')
 
+        debug(f'Found ModemManager modem: {object_path}')
+        self._object_path: str = object_path
+
+        # Get IMEI and network information
+        props: dict = interfaces[MM_INTERFACE_MODEM_3GPP]
+        self._imei: str = str(props['Imei'])
+        device_identifier = interfaces.get(MM_INTERFACE_MODEM, {}).get('DeviceIdentifier')
+        self._device_identifier: str | None = \
+            str(device_identifier) if device_identifier else None
+        # Empty while not registered, like oFono leave the network out then
+        self._network: str | None = str(props['OperatorName']) or None
+        self._mcc, self._mnc = split_operator_code(str(props['OperatorCode']))
+
+        # Not registered to a network, try the 3GPP location if it is enabled
+        location_props: dict = interfaces.get(MM_INTERFACE_LOCATION, {})
+        if not self._mcc and location_props.get('Enabled', 0) & MM_LOCATION_3GPP:
+            try:
+                location: dict = call(MM_NAME, object_path,
+                                      MM_INTERFACE_LOCATION,
+                                      MM_METHOD_GET_LOCATION, timeout)
+                location_3gpp: str = location[MM_LOCATION_3GPP]
+                self._mcc, self._mnc = location_3gpp.split(',')[:2]
+            except Exception as e:
+                debug(f'Unable to get 3GPP location: {e}')
+
+    def watch(self, callback):
+        def modem_3gpp_changed(interface, changed, invalidated):
+            if 'Imei' in changed:
+                self._imei = str(changed['Imei'])
+            if 'OperatorName' in changed:
+                self._network = str(changed['OperatorName']) or None
+            if 'OperatorCode' in changed:
+                self._mcc, self._mnc = \
+                    split_operator_code(str(changed['OperatorCode']))
+            debug(f'ModemManager 3GPP properties changed: {list(changed)}')
+            callback()
+
+        # Only the 3GPP interface of this modem, not every MM property
+        self._matches.append(system_bus().add_signal_receiver(
+            modem_3gpp_changed,
+            signal_name=FREEDESKTOP_SIGNAL_PROPERTIES_CHANGED,
+            dbus_interface=FREEDESKTOP_INTERFACE_PROPERTIES,
+            bus_name=MM_NAME,
+            path=self._object_path,
+            arg0=MM_INTERFACE_MODEM_3GPP))
+
     @property
     def imei(self) -> str:
         return self._imei
 
+    @property
+    def identity(self) -> str:
+        if self._device_identifier is None:
+            return super().identity
+        return f'{self.__class__.__name__}:{self._device_identifier}'
+
     @property
     def network(self) -> str:
         return self._network
@@ -178,28 +368,257 @@ class ModemManager(Modem):
     def mnc(self) -> str:
         return self._mnc
 
-def guess_modem() -> Optional[Modem]:
+def watch_modems(callback) -> list:
+    """
+    Call callback whenever a modem appears or disappears in any backend.
+    Requires a D-Bus main loop.
+    """
+    bus = system_bus()
+
+    def modems_changed(*args):
+        debug('Modems changed')
+        callback()
+
+    return [
+        bus.add_signal_receiver(modems_changed,
+                                signal_name=signal_name,
+                                dbus_interface=OFONO_INTERFACE_MANAGER,
+                                bus_name=OFONO_NAME,
+                                path=OFONO_OBJECT_PATH)
+        for signal_name in (OFONO_SIGNAL_MODEM_ADDED,
+                            OFONO_SIGNAL_MODEM_REMOVED)
+    ] + [
+        bus.add_signal_receiver(modems_changed,
+                                signal_name=signal_name,
+                                dbus_interface=FREEDESKTOP_INTERFACE_OBJECT_MANAGER,
+                                bus_name=MM_NAME,
+                                path=MM_OBJECT_PATH)
+        for signal_name in (FREEDESKTOP_SIGNAL_INTERFACES_ADDED,
+                            FREEDESKTOP_SIGNAL_INTERFACES_REMOVED)
+    ]
+
+# In order of preference
+MODEM_BACKENDS = [Ofono, ModemManager]
+# Names of the backends for --backend and the configuration
+BACKEND_NAMES = {
+    'ofono': Ofono,
+    'mm': ModemManager
+}
+BACKEND_NONE = 'none'
+
+# Activatable services only change when packages are installed
+_activatable_names: set | None = None
+
+def parse_backends(value: str) -> list:
+    """
+    Parse a comma separated list of backend names in order of preference,
+    'none' for no backend at all.
+    """
+    value = value.strip().lower()
+    if value == BACKEND_NONE:
+        return []
+
+    backends = []
+    for name in value.split(','):
+        backend = BACKEND_NAMES.get(name.strip())
+        if backend is None:
+            raise ValueError(f'Unknown modem backend: {name.strip()}')
+        if backend not in backends:
+            backends.append(backend)
+    return backends
+
+def configured_backends() -> list | None:
     """
-    Tries to access the DBus interface of each support modem backend.
-    The first backend that is available will be returned.
+    Backends pinned by BACKEND in the configuration file, None if unset.
     """
-    m: Optional[Modem] = None
+    config = read_env_file(environ.get('OBEX_CAPABILITIES_CONFIG', CONFIG_PATH))
+    if config is None or not config.get(CONFIG_BACKEND):
+        return None
 
-    # Ofono
     try:
-        debug('Trying to access oFono DBus interface')
-        m = Ofono()
-        return m
-    except Exception as e:
-        debug(f'Unable to use oFono DBus interface: {e}')
+        return parse_backends(config[CONFIG_BACKEND])
+    except ValueError as e:
+        debug(f'Ignoring configured backend: {e}')
+        return None
+
+def load_last_backend() -> str | None:
+    payload = read_checked(join(state_dir(), BACKEND_STATE_FILE))
+    return payload.decode(errors='replace') if payload is not None else None
+
+def store_last_backend(name: str):
+    try:
+        write_atomic(join(state_dir(), BACKEND_STATE_FILE), name.encode())
+    except OSError as e:
+        debug(f'Unable to store modem backend: {e}')
+
+def preferred_backends(last: str | None) -> list:
+    """
+    Every backend, the one that found a modem last time first.
+    """
+    backends = list(MODEM_BACKENDS)
+    for backend in backends:
+        if backend.__name__ == last:
+            backends.remove(backend)
+            backends.insert(0, backend)
+            break
+    return backends
+
+def running_backends(allow_activation: bool,
+                     timeout: float = PROBE_TIMEOUT,
+                     candidates: list | None = None) -> list:
+    """
+    Modem backends whose D-Bus service is running. Talking to a service that
+    is not running either starts it through bus activation, blocking until
+    it is up, or fails after a round trip, so those are skipped unless
+    activation is allowed.
+    """
+    global _activatable_names
+
+    names = set(call(FREEDESKTOP_NAME, FREEDESKTOP_OBJECT_PATH,
+                     FREEDESKTOP_INTERFACE_DBUS, FREEDESKTOP_METHOD_LIST_NAMES,
+                     timeout))
+    if allow_activation:
+        if _activatable_names is None:
+            _activatable_names = set(call(FREEDESKTOP_NAME, FREEDESKTOP_OBJECT_PATH,
+                                          FREEDESKTOP_INTERFACE_DBUS,
+                                          FREEDESKTOP_METHOD_LIST_ACTIVATABLE_NAMES,
+                                          timeout))
+        names |= _activatable_names
 
-    # ModemManager
+    backends = []
+    for backend in MODEM_BACKENDS if candidates is None else candidates:
+        if backend.BUS_NAME in names:
+            backends.append(backend)
+        else:
+            debug(f'{backend.BUS_NAME} is not running, skipping {backend.__name__}')
+    return backends
+
+def backend_invocations() -> dict:
+    """
+    systemd invocation ID of every backend service, None if it is not
+    running. Every start of a service gives it a new one.
+    """
+    invocations = {}
+    for backend in MODEM_BACKENDS:
+        try:
+            invocations[backend.UNIT] = \
+                readlink(join(SYSTEMD_UNITS_PATH, f'invocation:{backend.UNIT}'))
+        except OSError:
+            invocations[backend.UNIT] = None
+    return invocations
+
+def no_modem_cached(candidates: list, allow_activation: bool) -> bool:
+    """
+    Whether no modem was found recently among the candidate backends, during
+    this boot and without any backend service starting since. Without
+    activation allowed back then, it only counts for runs not allowing it.
+    """
+    payload = read_checked(join(runtime_dir(), NO_MODEM_CACHE_FILE))
+    if payload is None:
+        return False
+
+    try:
+        created, boot_id, invocations, names, activated = marshal.loads(payload)
+    except (ValueError, EOFError, TypeError):
+        return False
+
+    ttl = float(environ.get('NO_MODEM_CACHE_TTL', NO_MODEM_CACHE_TTL))
+    return 0 <= time() - created <= ttl and boot_id == modem_fingerprint() \
+        and invocations == backend_invocations() \
+        and names == [backend.__name__ for backend in candidates] \
+        and (activated or not allow_activation)
+
+def store_no_modem(candidates: list, allow_activation: bool):
+    payload = marshal.dumps((time(), modem_fingerprint(), backend_invocations(),
+                             [backend.__name__ for backend in candidates],
+                             allow_activation))
+    try:
+        write_atomic(join(runtime_dir(), NO_MODEM_CACHE_FILE), payload)
+    except OSError as e:
+        debug(f'Unable to write modem cache: {e}')
+
+def clear_no_modem():
     try:
-        debug('Trying to access ModemManager DBus interface')
-        m = ModemManager()
-        return m
+        unlink(join(runtime_dir(), NO_MODEM_CACHE_FILE))
+    except OSError:
+        pass
+
+def probe(backend, timeout: float):
+    """
+    Construct a modem backend in a thread, returns a Future with the result.
+    """
+    def construct() -> Modem:
+        debug(f'Trying to access {backend.__name__} DBus interface')
+        return backend(timeout)
+
+    return in_thread(construct, backend.__name__)
+
+def guess_modem(timeout: float | None = None,
+                allow_activation: bool | None = None,
+                use_cache: bool = True,
+                backends: list | None = None) -> Modem | None:
+    """
+    Probes the DBus interface of every running modem backend concurrently.
+    The most preferred backend that is available within timeout seconds
+    will be returned, backends still probing after that are ignored.
+    backends pins the backends to use in order of preference, otherwise
+    the configuration does or the backend that found a modem last time is
+    preferred. Services are only started through bus activation if
+    allow_activation is set. Raises TimeoutError if no backend could be
+    used and at least one of them did not answer in time. Unless use_cache
+    is False, finding no modem is remembered for NO_MODEM_CACHE_TTL seconds.
+    """
+    adaptive = False
+    if backends is None:
+        backends = configured_backends()
+    if backends is None:
+        adaptive = True
+        last = load_last_backend()
+        backends = preferred_backends(last)
+    if not backends:
+        debug('Modem backends disabled')
+        return None
+
+    if allow_activation is None:
+        allow_activation = environ.get('MODEM_ALLOW_ACTIVATION') == '1'
+    if use_cache and no_modem_cached(backends, allow_activation):
+        debug('No modem found recently, skipping DBus')
+        return None
+
+    if timeout is None:
+        timeout = float(environ.get('MODEM_PROBE_TIMEOUT', PROBE_TIMEOUT))
+    deadline = monotonic() + timeout
+    messages = message_count()
+
+    try:
+        running = running_backends(allow_activation, timeout, backends)
     except Exception as e:
-        debug(f'Unable to use ModemManager DBus interface: {e}')
+        debug(f'Unable to list DBus services: {e}')
+        return None
+
+    m: Modem | None = None
+    timed_out: bool = False
+    probes = [(backend, probe(backend, timeout)) for backend in running]
+    for backend, future in probes:
+        try:
+            m = future.result(timeout=max(0.0, deadline - monotonic()))
+            break
+        except TimeoutError:
+            debug(f'{backend.__name__} DBus interface did not answer in time')
+            timed_out = True
+        except Exception as e:
+            debug(f'Unable to use {backend.__name__} DBus interface: {e}')
+    else:
+        debug('No suitable modem backend available')
+
+    debug(f'Probing modems took {message_count() - messages} D-Bus messages')
+    if m is None and timed_out:
+        raise TimeoutError('Modem backends did not answer in time')
 
-    debug('No suitable modem backend available')
+    if m is not None:
+        clear_no_modem()
+        if adaptive and backend.__name__ != last:
+            store_last_backend(backend.__name__)
+    elif use_cache:
+        store_no_modem(backends, allow_activation)
     return m
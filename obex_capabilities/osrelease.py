@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from os import environ
+from types import MappingProxyType
+
+from .log import debug
+from .cache import stamp
+
+OS_RELEASE_PATH = '/etc/os-release'
+OS_RELEASE_FALLBACK_PATH = '/usr/lib/os-release'
+# Characters a backslash escapes within double quotes
+SHELL_DOUBLE_QUOTE_ESCAPES = '$"\\`'
+
+# Parsed files of this process, path -> (stamp, keys)
+_parsed: dict = {}
+
+def os_release_paths() -> list:
+    """
+    Candidate os-release files in order of preference, OS_RELEASE_PATH
+    replaces both.
+    """
+    path = environ.get('OS_RELEASE_PATH')
+    if path is not None:
+        return [path]
+    return [OS_RELEASE_PATH, OS_RELEASE_FALLBACK_PATH]
+
+def unquote(value: str) -> str:
+    """
+    Undo the shell quoting and escaping os-release values may use.
+    """
+    result = []
+    quote = None
+    chars = iter(value)
+    for c in chars:
+        if quote == "'":
+            if c == "'":
+                quote = None
+            else:
+                result.append(c)
+        elif c == '\\':
+            escaped = next(chars, '')
+            if quote == '"' and escaped not in SHELL_DOUBLE_QUOTE_ESCAPES:
+                result.append(c)
+            result.append(escaped)
+        elif c == quote:
+            quote = None
+        elif quote is None and c in '"\'':
+            quote = c
+        else:
+            result.append(c)
+    return ''.join(result)
+
+def parse_env_file(path: str) -> dict:
+    """
+    Parse a file of shell-style KEY=value assignments like os-release.
+    """
+    keys = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            key, sep, value = line.partition('=')
+            if sep:
+                keys[key.strip()] = unquote(value.strip())
+
+    return keys
+
+def read_env_file(path: str) -> MappingProxyType | None:
+    """
+    Keys of a KEY=value file, parsed again only once it changed. A missing
+    file is remembered as None.
+    """
+    file_stamp = stamp(path)
+    cached = _parsed.get(path)
+    if cached is not None and cached[0] == file_stamp:
+        return cached[1]
+
+    keys = None
+    if file_stamp is not None:
+        debug(f'Parsing {path}')
+        try:
+            keys = MappingProxyType(parse_env_file(path))
+        except (OSError, UnicodeDecodeError) as e:
+            debug(f'Unable to read {path}: {e}')
+
+    _parsed[path] = (file_stamp, keys)
+    return keys
+
+def os_release() -> MappingProxyType:
+    """
+    Every key of the os-release file, empty if there is none.
+    """
+    for path in os_release_paths():
+        keys = read_env_file(path)
+        if keys is not None:
+            return keys
+    return MappingProxyType({})
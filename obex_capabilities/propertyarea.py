@@ -0,0 +1,226 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from os import environ
+from os.path import isdir, join
+from mmap import mmap, PROT_READ
+from struct import unpack_from, error as StructError
+
+from .log import debug
+
+PROPERTY_AREA_PATH = '/dev/__properties__'
+PROPERTY_INFO_FILE = 'property_info'
+# Layout of bionic's prop_area, prop_bt and prop_info
+PROP_AREA_MAGIC = 0x504f5250
+PROP_AREA_VERSION = 0xfc6ed0ab
+PROP_AREA_HEADER_SIZE = 128
+PROP_BT_NAME = 20
+PROP_BT_PROP = 4
+PROP_BT_CHILDREN = 16
+PROP_INFO_VALUE = 4
+PROP_INFO_LONG_OFFSET = 60
+PROP_INFO_LONG_FLAG = 1 << 16
+
+# Layout of bionic's property_info, the trie mapping property names to the
+# SELinux context, and so the area, they are stored in
+PROPERTY_INFO_HEADER = '=6I'
+PROPERTY_INFO_NODE = '=7I'
+PROPERTY_INFO_ENTRY = '=3I'
+PROPERTY_INFO_NONE = 0xffffffff
+
+# Mapped files of this process, path -> PropertyArea, PropertyInfo or None
+_mapped: dict = {}
+
+class PropertyArea:
+    """
+    A read-only memory mapping of one Android property area. Properties are
+    looked up by walking the trie in the mapping, nothing is copied besides
+    the names compared on the way and the value found.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap(f.fileno(), 0, prot=PROT_READ)
+
+        _, _, magic, version = unpack_from('=4I', self._map, 0)
+        if magic != PROP_AREA_MAGIC or version != PROP_AREA_VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a property area')
+
+    def _find_child(self, offset: int, name: bytes) -> int | None:
+        """
+        Search the binary tree of children starting at offset for name,
+        ordered by length first and content second like bionic does.
+        """
+        while offset:
+            node = PROP_AREA_HEADER_SIZE + offset
+            namelen, _, left, right = unpack_from('=4I', self._map, node)
+            if len(name) != namelen:
+                smaller = len(name) < namelen
+            else:
+                start = node + PROP_BT_NAME
+                node_name = self._map[start:start + namelen]
+                if name == node_name:
+                    return offset
+                smaller = name < node_name
+            offset = left if smaller else right
+        return None
+
+    def get(self, name: str) -> str | None:
+        """
+        Value of a property, None if it is not in this area.
+        """
+        offset = 0
+        for segment in name.encode().split(b'.'):
+            if not segment:
+                return None
+            node = PROP_AREA_HEADER_SIZE + offset
+            children, = unpack_from('=I', self._map, node + PROP_BT_CHILDREN)
+            offset = self._find_child(children, segment)
+            if offset is None:
+                return None
+
+        node = PROP_AREA_HEADER_SIZE + offset
+        prop, = unpack_from('=I', self._map, node + PROP_BT_PROP)
+        if not prop:
+            return None
+
+        info = PROP_AREA_HEADER_SIZE + prop
+        serial, = unpack_from('=I', self._map, info)
+        if serial & PROP_INFO_LONG_FLAG:
+            long_offset, = unpack_from('=I', self._map, info + PROP_INFO_LONG_OFFSET)
+            start = info + long_offset
+            value = self._map[start:self._map.find(b'\0', start)]
+        else:
+            start = info + PROP_INFO_VALUE
+            value = self._map[start:start + (serial >> 24)]
+        return value.decode(errors='replace')
+
+class PropertyInfo:
+    """
+    A read-only memory mapping of bionic's property_info, looked up like
+    bionic does to find the context of a property without mapping every
+    area.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._map = mmap(f.fileno(), 0, prot=PROT_READ)
+
+        _, _, _, self._contexts, _, self._root = \
+            unpack_from(PROPERTY_INFO_HEADER, self._map, 0)
+
+    def _uint32(self, offset: int) -> int:
+        return unpack_from('=I', self._map, offset)[0]
+
+    def _entry(self, offset: int) -> tuple:
+        """
+        Name and context index of the property entry at offset.
+        """
+        name_offset, namelen, context = \
+            unpack_from(PROPERTY_INFO_ENTRY, self._map, offset)
+        return self._map[name_offset:name_offset + namelen], context
+
+    def _match_prefix(self, node: tuple, name: bytes, context: int) -> int:
+        _, _, _, num_prefixes, prefixes, _, _ = node
+        for i in range(num_prefixes):
+            prefix, prefix_context = self._entry(self._uint32(prefixes + 4 * i))
+            if name.startswith(prefix):
+                if prefix_context != PROPERTY_INFO_NONE:
+                    return prefix_context
+                break
+        return context
+
+    def _find_child(self, node: tuple, segment: bytes) -> int | None:
+        _, num_children, children, _, _, _, _ = node
+        for i in range(num_children):
+            child = self._uint32(children + 4 * i)
+            entry = self._uint32(child)
+            if self._entry(entry)[0] == segment:
+                return child
+        return None
+
+    def context(self, name: str) -> str | None:
+        """
+        SELinux context of a property, None if it has none.
+        """
+        remaining = name.encode()
+        context = PROPERTY_INFO_NONE
+        offset = self._root
+        while True:
+            node = unpack_from(PROPERTY_INFO_NODE, self._map, offset)
+            node_context = self._entry(node[0])[1]
+            if node_context != PROPERTY_INFO_NONE:
+                context = node_context
+            # Prefixes stored at a node are longer than the node itself
+            context = self._match_prefix(node, remaining, context)
+
+            segment, sep, rest = remaining.partition(b'.')
+            if not sep:
+                break
+            child = self._find_child(node, segment)
+            if child is None:
+                break
+            offset, remaining = child, rest
+
+        _, _, _, _, _, num_exact, exact = node
+        for i in range(num_exact):
+            exact_name, exact_context = self._entry(self._uint32(exact + 4 * i))
+            if exact_name == remaining:
+                if exact_context != PROPERTY_INFO_NONE:
+                    context = exact_context
+                break
+        else:
+            context = self._match_prefix(node, remaining, context)
+
+        if context == PROPERTY_INFO_NONE:
+            return None
+        start = self._uint32(self._contexts + 4 + 4 * context)
+        return self._map[start:self._map.find(b'\0', start)].decode()
+
+def map_file(cls, path: str):
+    """
+    Map a property area or property_info once per process, None if it is
+    missing or invalid.
+    """
+    if path not in _mapped:
+        try:
+            _mapped[path] = cls(path)
+        except (OSError, ValueError, StructError) as e:
+            debug(f'Unable to map {path}: {e}')
+            _mapped[path] = None
+    return _mapped[path]
+
+def property_area(name: str) -> PropertyArea | None:
+    """
+    The property area holding a property. Newer Android releases have one
+    area per SELinux context, property_info tells which one, so only that
+    area is mapped. Older ones have a single area.
+    """
+    path = environ.get('PROPERTY_AREA_PATH', PROPERTY_AREA_PATH)
+    if not isdir(path):
+        return map_file(PropertyArea, path)
+
+    info = map_file(PropertyInfo, join(path, PROPERTY_INFO_FILE))
+    if info is None:
+        return None
+    try:
+        context = info.context(name)
+    except (StructError, IndexError, ValueError) as e:
+        debug(f'Corrupted property info: {e}')
+        return None
+    if context is None or '/' in context:
+        return None
+    return map_file(PropertyArea, join(path, context))
+
+def get_property(name: str) -> str | None:
+    """
+    Value of a live Android property, None if it or its area is missing.
+    """
+    area = property_area(name)
+    if area is None:
+        return None
+    try:
+        return area.get(name)
+    except (StructError, IndexError, ValueError) as e:
+        debug(f'Corrupted property area: {e}')
+        return None
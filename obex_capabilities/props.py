@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import marshal
+from os.path import join
+from types import MappingProxyType
+
+from .log import debug
+from .cache import runtime_dir, read_checked, write_atomic, cached_stamp
+
+PROPS_CACHE_FILE = 'props.cache'
+
+# Where the Android partitions are mounted, in order of preference
+PROP_ROOTS = [
+    '/var/lib/lxc/android/rootfs',
+    '/android',
+    '/'
+]
+# build.prop locations of each partition, in the order Android loads them.
+# Properties of later partitions override those of earlier ones.
+PROP_PARTITIONS = [
+    ['system/build.prop'],
+    ['system_ext/etc/build.prop', 'system/system_ext/etc/build.prop'],
+    ['vendor/build.prop'],
+    ['odm/etc/build.prop', 'vendor/odm/etc/build.prop'],
+    ['product/etc/build.prop', 'product/build.prop', 'system/product/build.prop']
+]
+# Every file the properties may come from
+PROP_FILES = [
+    join(root, file)
+    for partition in PROP_PARTITIONS
+    for file in partition
+    for root in PROP_ROOTS
+]
+
+# Parsed build.prop files of this process, path -> (stamp, properties)
+_prop_files: dict = {}
+# Merged properties of this process, (files, properties)
+_props: tuple | None = None
+
+def parse_prop_file(path: str) -> dict:
+    """
+    Parse an Android build.prop file. Like Android, later definitions of a
+    property override earlier ones.
+    """
+    props = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            key, sep, value = line.partition('=')
+            if sep:
+                props[key.strip()] = value.strip()
+
+    return props
+
+def load_props_cache() -> dict:
+    payload = read_checked(join(runtime_dir(), PROPS_CACHE_FILE))
+    if payload is None:
+        return {}
+
+    try:
+        return marshal.loads(payload)
+    except (ValueError, EOFError, TypeError):
+        return {}
+
+def store_props_cache(cache: dict):
+    try:
+        write_atomic(join(runtime_dir(), PROPS_CACHE_FILE), marshal.dumps(cache))
+    except OSError as e:
+        debug(f'Unable to write property cache: {e}')
+
+def partition_files(stamps: dict) -> list:
+    """
+    The build.prop file of each partition that has one, with its stamp.
+    Looked up once per resolution, stamps holds the ones taken so far.
+    """
+    files = []
+    for partition in PROP_PARTITIONS:
+        for file in partition:
+            for root in PROP_ROOTS:
+                path = join(root, file)
+                file_stamp = cached_stamp(path, stamps)
+                if file_stamp is not None:
+                    files.append((path, file_stamp))
+                    break
+            else:
+                continue
+            break
+    return files
+
+def prop_guards(files: list, stamps: dict) -> dict:
+    """
+    Stamps of the build.prop files deciding which properties files from
+    partition_files() hold: those files and the most preferred location of
+    each partition, which takes precedence once it appears.
+    """
+    guards = dict(files)
+    for partition in PROP_PARTITIONS:
+        path = join(PROP_ROOTS[0], partition[0])
+        guards[path] = cached_stamp(path, stamps)
+    return guards
+
+def load_prop_files(files: list) -> list:
+    """
+    Properties of each of the given build.prop files with their stamps. Files
+    are only parsed if they changed since this process or the property cache
+    saw them.
+    """
+    cache = None
+    changed = False
+    props = []
+    for path, file_stamp in files:
+        cached = _prop_files.get(path)
+        if cached is None or cached[0] != file_stamp:
+            if cache is None:
+                cache = load_props_cache()
+            cached = cache.get(path)
+            if cached is None or cached[0] != file_stamp:
+                debug(f'Parsing {path}')
+                cached = (file_stamp, parse_prop_file(path))
+                cache[path] = cached
+                changed = True
+            _prop_files[path] = cached
+        props.append(cached[1])
+
+    if changed:
+        store_props_cache(cache)
+    return props
+
+def file_props(path: str, file_stamp: list) -> dict:
+    """
+    Properties of a single build.prop file, parsed only if it changed.
+    """
+    return load_prop_files([(path, file_stamp)])[0]
+
+def prop_source(name: str, files: list) -> tuple | None:
+    """
+    The build.prop file among files that sets the merged value of a
+    property, with its stamp. None if no file does.
+    """
+    sources = zip(files, load_prop_files(files))
+    for (path, file_stamp), props in reversed(list(sources)):
+        if name in props:
+            return path, file_stamp
+    return None
+
+def read_props(files: list) -> MappingProxyType:
+    """
+    Properties of the build.prop files from partition_files() merged in one
+    read-only mapping. Files are parsed once and the result is kept next to
+    the capability cache until one of them changes.
+    """
+    global _props
+    if _props is not None and _props[0] == files:
+        return _props[1]
+
+    merged = {}
+    for props in load_prop_files(files):
+        merged.update(props)
+
+    _props = (files, MappingProxyType(merged))
+    return _props[1]
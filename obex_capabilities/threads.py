@@ -0,0 +1,21 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+def in_thread(func, name: str | None = None):
+    """
+    Run func in a thread, returns a Future with the result. Daemon threads,
+    a wedged D-Bus service must not keep the process alive.
+    """
+    # Imported here, cached runs never start a thread
+    from concurrent.futures import Future
+    from threading import Thread
+
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=run, name=name, daemon=True).start()
+    return future
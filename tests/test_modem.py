@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+from threading import Lock
+from unittest import mock
+
+from obex_capabilities import generate_capabilities, modem
+from obex_capabilities.device import DeviceSnapshot
+from obex_capabilities.modem import ModemManager, Ofono
+
+MM_MODEM_PATH = '/org/freedesktop/ModemManager1/Modem/0'
+OFONO_MODEM_PATH = '/ril_0'
+LIST_NAMES = (modem.FREEDESKTOP_NAME, modem.FREEDESKTOP_OBJECT_PATH,
+              modem.FREEDESKTOP_INTERFACE_DBUS, modem.FREEDESKTOP_METHOD_LIST_NAMES)
+DEVICE = DeviceSnapshot('Vendor', 'Model', 'board', '1234', '1.0', '1.0')
+
+class FakeBus:
+    """
+    System bus answering method calls from replies, keyed by bus name,
+    object path, interface and method.
+    """
+
+    def __init__(self, replies: dict):
+        self._replies = replies
+        self.calls: list = []
+
+    def call_blocking(self, bus_name, object_path, interface, method,
+                      signature, args, timeout):
+        self.calls.append((bus_name, object_path, interface, method))
+        try:
+            return self._replies[bus_name, object_path, interface, method]
+        except KeyError:
+            raise RuntimeError(f'No reply for {interface}.{method}')
+
+class ModemTest(unittest.TestCase):
+    def use_bus(self, replies: dict) -> FakeBus:
+        bus = FakeBus(replies)
+        for patch in (mock.patch.object(modem, 'system_bus', return_value=bus),
+                      mock.patch.object(modem, '_messages_lock', Lock()),
+                      mock.patch.object(modem, '_activatable_names', None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        return bus
+
+    def use_mm(self, props_3gpp: dict, interfaces: dict | None = None,
+               replies: dict | None = None) -> FakeBus:
+        objects = {
+            '/org/freedesktop/ModemManager1/SIM/0': {
+                'org.freedesktop.ModemManager1.Sim': {'Imsi': '208150123456789'}
+            },
+            MM_MODEM_PATH: {modem.MM_INTERFACE_MODEM_3GPP: props_3gpp,
+                            **(interfaces or {})}
+        }
+        return self.use_bus({
+            LIST_NAMES: [modem.FREEDESKTOP_NAME, modem.MM_NAME],
+            (modem.MM_NAME, modem.MM_OBJECT_PATH,
+             modem.FREEDESKTOP_INTERFACE_OBJECT_MANAGER,
+             modem.FREEDESKTOP_METHOD_GET_MANAGED_OBJECTS): objects,
+            **(replies or {})
+        })
+
+    def use_ofono(self, props: dict,
+                  network_registration: dict | None = None) -> FakeBus:
+        replies = {
+            LIST_NAMES: [modem.FREEDESKTOP_NAME, modem.OFONO_NAME],
+            (modem.OFONO_NAME, modem.OFONO_OBJECT_PATH,
+             modem.OFONO_INTERFACE_MANAGER,
+             modem.OFONO_METHOD_GET_MODEMS): [(OFONO_MODEM_PATH, props)] if props else []
+        }
+        if network_registration is not None:
+            replies[modem.OFONO_NAME, OFONO_MODEM_PATH,
+                    modem.OFONO_INTERFACE_NETWORK_REGISTRATION,
+                    modem.OFONO_METHOD_GET_PROPERTIES] = network_registration
+        return self.use_bus(replies)
+
+    def use_runtime_dir(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patch = mock.patch.dict(os.environ, CACHE_DIR=directory.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_mm_one_call(self):
+        self.use_runtime_dir()
+        self.use_mm({'Imei': '490154203237518', 'OperatorName': 'Orange F',
+                     'OperatorCode': '20801'},
+                    {modem.MM_INTERFACE_MODEM: {'DeviceIdentifier': 'abc123'}})
+
+        messages = modem.message_count()
+        mm = modem.guess_modem(use_cache=False, backends=[ModemManager])
+        # ListNames and GetManagedObjects, nothing per property
+        self.assertEqual(modem.message_count() - messages, 2)
+
+        self.assertIsInstance(mm, ModemManager)
+        self.assertEqual(mm.imei, '490154203237518')
+        self.assertEqual(mm.identity, 'ModemManager:abc123')
+        self.assertEqual((mm.network, mm.mcc, mm.mnc), ('Orange F', '208', '01'))
+        self.assertIn('<XVal>CurrentNetwork=Orange F</XVal>',
+                      generate_capabilities(DEVICE, mm))
+
+    def test_mm_three_digit_mnc(self):
+        self.use_mm({'Imei': '490154203237518', 'OperatorName': 'AT&T',
+                     'OperatorCode': '310410'})
+        mm = ModemManager()
+
+        self.assertEqual(mm.identity, 'ModemManager:490154203237518')
+        self.assertEqual((mm.mcc, mm.mnc), ('310', '410'))
+
+    def test_mm_no_modem(self):
+        self.use_bus({
+            (modem.MM_NAME, modem.MM_OBJECT_PATH,
+             modem.FREEDESKTOP_INTERFACE_OBJECT_MANAGER,
+             modem.FREEDESKTOP_METHOD_GET_MANAGED_OBJECTS): {}
+        })
+        with self.assertRaises(RuntimeError):
+            ModemManager()
+
+    def test_mm_unregistered_location(self):
+        bus = self.use_mm(
+            {'Imei': '490154203237518', 'OperatorName': '', 'OperatorCode': ''},
+            {modem.MM_INTERFACE_LOCATION: {'Enabled': modem.MM_LOCATION_3GPP}},
+            {(modem.MM_NAME, MM_MODEM_PATH, modem.MM_INTERFACE_LOCATION,
+              modem.MM_METHOD_GET_LOCATION): {
+                  modem.MM_LOCATION_3GPP: '208,01,1a2b,0123abcd,0'
+              }})
+        mm = ModemManager()
+
+        self.assertEqual(len(bus.calls), 2)
+        self.assertEqual((mm.network, mm.mcc, mm.mnc), (None, '208', '01'))
+        self.assertNotIn('NetworkInfo', generate_capabilities(DEVICE, mm))
+
+    def test_mm_unregistered(self):
+        self.use_mm({'Imei': '490154203237518', 'OperatorName': '',
+                     'OperatorCode': ''})
+        mm = ModemManager()
+
+        self.assertEqual(mm.imei, '490154203237518')
+        self.assertIsNone(mm.network)
+        self.assertNotIn('NetworkInfo', generate_capabilities(DEVICE, mm))
+
+    def test_ofono_registered(self):
+        self.use_runtime_dir()
+        self.use_ofono({'Serial': '490154203237518', 'Powered': True, 'Online': True,
+                        'Interfaces': [modem.OFONO_INTERFACE_MODEM,
+                                       modem.OFONO_INTERFACE_NETWORK_REGISTRATION]},
+                       {'Name': 'Orange F', 'MobileCountryCode': '208',
+                        'MobileNetworkCode': '01', 'Status': 'registered'})
+
+        messages = modem.message_count()
+        ofono = modem.guess_modem(use_cache=False, backends=[Ofono])
+        # ListNames, GetModems and the network registration
+        self.assertEqual(modem.message_count() - messages, 3)
+
+        self.assertIsInstance(ofono, Ofono)
+        self.assertEqual(ofono.imei, '490154203237518')
+        self.assertEqual((ofono.network, ofono.mcc, ofono.mnc),
+                         ('Orange F', '208', '01'))
+
+    def test_ofono_offline(self):
+        bus = self.use_ofono({'Serial': '490154203237518', 'Powered': True,
+                              'Online': False,
+                              'Interfaces': [modem.OFONO_INTERFACE_MODEM]})
+        ofono = Ofono()
+
+        # Offline modems have no network registration to ask for
+        self.assertEqual(len(bus.calls), 1)
+        self.assertEqual(ofono.imei, '490154203237518')
+        self.assertIsNone(ofono.network)
+        self.assertNotIn('NetworkInfo', generate_capabilities(DEVICE, ofono))
+
+    def test_ofono_no_modem(self):
+        self.use_ofono({})
+        with self.assertRaises(RuntimeError):
+            Ofono()
+
+    def test_ofono_without_imei(self):
+        self.use_ofono({'Powered': False, 'Interfaces': []})
+        with self.assertRaises(RuntimeError):
+            Ofono()
+
+    def test_no_modem_cache_activation(self):
+        self.use_runtime_dir()
+        bus = self.use_bus({
+            LIST_NAMES: [],
+            (modem.FREEDESKTOP_NAME, modem.FREEDESKTOP_OBJECT_PATH,
+             modem.FREEDESKTOP_INTERFACE_DBUS,
+             modem.FREEDESKTOP_METHOD_LIST_ACTIVATABLE_NAMES): []
+        })
+
+        # Nothing running without activation says nothing about activating
+        self.assertIsNone(modem.guess_modem(allow_activation=False,
+                                            backends=[ModemManager]))
+        self.assertIsNone(modem.guess_modem(allow_activation=True,
+                                            backends=[ModemManager]))
+        self.assertEqual(len(bus.calls), 3)
+
+        # Nothing found with activation holds for runs without it
+        self.assertIsNone(modem.guess_modem(allow_activation=False,
+                                            backends=[ModemManager]))
+        self.assertEqual(len(bus.calls), 3)
+
+if __name__ == '__main__':
+    unittest.main()
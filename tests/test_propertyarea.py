@@ -0,0 +1,211 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+from struct import pack, pack_into
+
+from obex_capabilities import propertyarea
+from obex_capabilities.propertyarea import PROP_AREA_MAGIC, PROP_AREA_VERSION, \
+    PROPERTY_INFO_FILE, PROPERTY_INFO_NONE, PropertyArea, PropertyInfo
+
+PROP_VALUE_MAX = 92
+PROP_INFO_NAME = 96
+
+def align(data: bytearray, size: int) -> int:
+    """
+    Allocate size bytes in data, 4 byte aligned like bionic does.
+    """
+    offset = len(data)
+    data.extend(bytes((size + 3) & ~3))
+    return offset
+
+def build_area(props: dict) -> bytes:
+    """
+    Build a property area holding props like bionic's prop_area.
+    """
+    data = bytearray()
+    root = align(data, 20)
+
+    # segment -> [(name, value) or None, children]
+    trie: dict = {}
+    for name, value in props.items():
+        node = trie
+        segments = name.encode().split(b'.')
+        for i, segment in enumerate(segments):
+            entry = node.setdefault(segment, [None, {}])
+            if i == len(segments) - 1:
+                entry[0] = (name, value)
+            node = entry[1]
+
+    def write_info(name: str, value: str) -> int:
+        name, value = name.encode(), value.encode()
+        offset = align(data, PROP_INFO_NAME + len(name) + 1)
+        data[offset + PROP_INFO_NAME:offset + PROP_INFO_NAME + len(name)] = name
+        if len(value) < PROP_VALUE_MAX:
+            pack_into('=I', data, offset, len(value) << 24)
+            data[offset + 4:offset + 4 + len(value)] = value
+        else:
+            long_offset = align(data, len(value) + 1)
+            data[long_offset:long_offset + len(value)] = value
+            pack_into('=I', data, offset, propertyarea.PROP_INFO_LONG_FLAG)
+            pack_into('=I', data, offset + 60, long_offset - offset)
+        return offset
+
+    def write_node(segment: bytes, entry: list) -> int:
+        offset = align(data, 20 + len(segment) + 1)
+        data[offset + 20:offset + 20 + len(segment)] = segment
+        prop = write_info(*entry[0]) if entry[0] is not None else 0
+        pack_into('=2I', data, offset, len(segment), prop)
+        pack_into('=I', data, offset + 16, write_level(entry[1]))
+        return offset
+
+    def write_level(children: dict) -> int:
+        # Binary tree ordered by length first and content second
+        keys = sorted(children, key=lambda key: (len(key), key))
+
+        def write_tree(low: int, high: int) -> int:
+            if low >= high:
+                return 0
+            middle = (low + high) // 2
+            offset = write_node(keys[middle], children[keys[middle]])
+            pack_into('=2I', data, offset + 8, write_tree(low, middle),
+                      write_tree(middle + 1, high))
+            return offset
+
+        return write_tree(0, len(keys))
+
+    pack_into('=I', data, root + 16, write_level(trie))
+    header = pack('=4I', len(data), 0, PROP_AREA_MAGIC, PROP_AREA_VERSION)
+    return header.ljust(propertyarea.PROP_AREA_HEADER_SIZE, b'\0') + bytes(data)
+
+def build_info(contexts: list, node_contexts: dict, prefixes: dict,
+               exact: dict) -> bytes:
+    """
+    Build a property_info like bionic's serializer. node_contexts maps
+    dot separated prefixes to a context, prefixes and exact map a node
+    prefix to {remaining name: context}.
+    """
+    data = bytearray(24)
+
+    def string(value: str) -> int:
+        offset = align(data, len(value) + 1)
+        data[offset:offset + len(value)] = value.encode()
+        return offset
+
+    def entry(name: str, context: str | None) -> int:
+        name_offset = string(name)
+        offset = align(data, 16)
+        index = contexts.index(context) if context is not None else PROPERTY_INFO_NONE
+        pack_into('=4I', data, offset, name_offset, len(name), index,
+                  PROPERTY_INFO_NONE)
+        return offset
+
+    def array(offsets: list) -> int:
+        offset = align(data, 4 * len(offsets))
+        for i, value in enumerate(offsets):
+            pack_into('=I', data, offset + 4 * i, value)
+        return offset
+
+    contexts_offset = align(data, 4 + 4 * len(contexts))
+    pack_into('=I', data, contexts_offset, len(contexts))
+    for i, context in enumerate(contexts):
+        pack_into('=I', data, contexts_offset + 4 + 4 * i, string(context))
+    types_offset = array([0])
+
+    def write_node(path: str, segment: str) -> int:
+        children = sorted({key[len(path):].split('.')[0] for key in node_contexts
+                           if key.startswith(path) and key != path})
+        child_offsets = [write_node(f'{path}{child}.', child) for child in children]
+        prefix_offsets = [entry(name, context)
+                          for name, context in prefixes.get(path, {}).items()]
+        exact_offsets = [entry(name, context)
+                         for name, context in exact.get(path, {}).items()]
+        offset = align(data, 28)
+        pack_into('=7I', data, offset, entry(segment, node_contexts.get(path)),
+                  len(child_offsets), array(child_offsets),
+                  len(prefix_offsets), array(prefix_offsets),
+                  len(exact_offsets), array(exact_offsets))
+        return offset
+
+    root = write_node('', 'root')
+    pack_into('=6I', data, 0, 1, 1, len(data), contexts_offset, types_offset, root)
+    return bytes(data)
+
+class PropertyAreaTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        propertyarea._mapped.clear()
+        self.addCleanup(propertyarea._mapped.clear)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self._dir.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_lookup(self):
+        props = {f'ro.product.key{i}.name{i % 7}': f'value {i}' for i in range(300)}
+        props['ro.product.vendor.model'] = 'FP5'
+        props['ro.product.board'] = 'fp5'
+        props['ro.long'] = 'x' * 200
+        area = PropertyArea(self.write('area', build_area(props)))
+
+        for name, value in props.items():
+            self.assertEqual(area.get(name), value)
+        self.assertIsNone(area.get('ro.product'))
+        self.assertIsNone(area.get('ro.product.missing'))
+        self.assertIsNone(area.get('ro..model'))
+
+    def test_invalid_area(self):
+        path = self.write('area', bytes(256))
+        with self.assertRaises(ValueError):
+            PropertyArea(path)
+
+    def test_property_info(self):
+        contexts = ['default_prop', 'build_prop', 'vendor_prop', 'odm_prop']
+        info = PropertyInfo(self.write(PROPERTY_INFO_FILE, build_info(
+            contexts,
+            {'': 'default_prop', 'ro.': None, 'ro.product.': 'build_prop'},
+            {'ro.product.': {'vendor': 'vendor_prop'}},
+            {'ro.product.': {'odm.model': 'odm_prop'}})))
+
+        self.assertEqual(info.context('persist.sys.foo'), 'default_prop')
+        self.assertEqual(info.context('ro.build.id'), 'default_prop')
+        self.assertEqual(info.context('ro.product.board'), 'build_prop')
+        self.assertEqual(info.context('ro.product.vendor.model'), 'vendor_prop')
+        self.assertEqual(info.context('ro.product.odm.model'), 'odm_prop')
+        self.assertEqual(info.context('ro.product.odm.device'), 'build_prop')
+
+    def test_maps_only_the_needed_area(self):
+        contexts = [f'context{i}' for i in range(50)] + ['build_prop']
+        self.write(PROPERTY_INFO_FILE, build_info(
+            contexts, {'': 'context0', 'ro.': None, 'ro.product.': 'build_prop'},
+            {}, {}))
+        for context in contexts:
+            self.write(context, build_area({'unrelated.key': context}))
+        self.write('build_prop', build_area({'ro.product.vendor.model': 'FP5'}))
+        os.environ['PROPERTY_AREA_PATH'] = self._dir.name
+        self.addCleanup(os.environ.pop, 'PROPERTY_AREA_PATH')
+
+        self.assertEqual(propertyarea.get_property('ro.product.vendor.model'), 'FP5')
+        self.assertIsNone(propertyarea.get_property('ro.product.model'))
+        self.assertEqual(sorted(os.path.basename(path) for path in propertyarea._mapped),
+                         ['build_prop', PROPERTY_INFO_FILE])
+
+    def test_single_area(self):
+        os.environ['PROPERTY_AREA_PATH'] = \
+            self.write('__properties__', build_area({'ro.product.model': 'FP5'}))
+        self.addCleanup(os.environ.pop, 'PROPERTY_AREA_PATH')
+
+        self.assertEqual(propertyarea.get_property('ro.product.model'), 'FP5')
+
+    def test_missing_area(self):
+        os.environ['PROPERTY_AREA_PATH'] = os.path.join(self._dir.name, 'missing')
+        self.addCleanup(os.environ.pop, 'PROPERTY_AREA_PATH')
+
+        self.assertIsNone(propertyarea.get_property('ro.product.model'))
+
+if __name__ == '__main__':
+    unittest.main()
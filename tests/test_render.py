@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import random
+import sys
+import unittest
+from timeit import Timer
+from types import SimpleNamespace
+from xml.etree import ElementTree
+
+from obex_capabilities import generate_capabilities
+from obex_capabilities.device import DeviceSnapshot
+
+# The template the capabilities used to be rendered from with ElementTree
+ELEMENTTREE_TEMPLATE = """<?xml version="1.0"?>
+<!DOCTYPE Capability SYSTEM "obex-capability.dtd">
+<Capability Version="1.0">
+ <General>
+  <Manufacturer></Manufacturer>
+  <Model></Model>
+  <SN></SN>
+  <SW version=""/>
+  <OS version="" id=""/>
+ </General>
+ <Service>
+  <UUID>SYNCML-SYNC</UUID>
+  <Name>SyncML</Name>
+  <Version>1.2</Version>
+  <Object>
+   <Type>application/vnd.syncml+wbxml</Type>
+   <Ext>
+    <XVal>application/vnd.syncml.ds.notification</XVal>
+    <XNam>ServerAlertedNotificationType</XNam>
+   </Ext>
+  </Object>
+ </Service>
+</Capability>"""
+ALPHABET = 'aZ09 &<>"\'\t\n\ré€𝄞=;'
+
+def render_elementtree(device, modem) -> str:
+    """
+    The capabilities as the ElementTree based renderer produced them.
+    """
+    root = ElementTree.fromstring(ELEMENTTREE_TEMPLATE)
+    root.find('./General/Manufacturer').text = device.manufacturer or ''
+    root.find('./General/Model').text = device.model or ''
+    root.find('./General/SN').text = device.unique_id or ''
+    root.find('./General/SW').set('version', device.software_version or '')
+    os = root.find('./General/OS')
+    os.set('version', device.os_version or '')
+    os.set('id', device.codename or '')
+
+    if modem is not None:
+        ext = ElementTree.SubElement(root.find('./General'), 'Ext')
+        ElementTree.SubElement(ext, 'XNam').text = 'NetworkInfo'
+        ElementTree.SubElement(ext, 'XVal').text = f'CurrentNetwork={modem.network}'
+        ElementTree.SubElement(ext, 'XVal').text = f'CountryCode={modem.mcc}'
+        ElementTree.SubElement(ext, 'XVal').text = f'NetworkID={modem.mnc}'
+
+    ElementTree.indent(root, space=' ')
+    return ElementTree.tostring(root).decode()
+
+def random_text(rng: random.Random) -> str | None:
+    r = rng.random()
+    if r < 0.15:
+        return None
+    if r < 0.3:
+        return ''
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 12)))
+
+class RenderTest(unittest.TestCase):
+    def test_matches_elementtree(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            device = DeviceSnapshot(*(random_text(rng) for _ in range(6)))
+            modem = None
+            if rng.random() < 0.5:
+                modem = SimpleNamespace(network=random_text(rng) or 'network',
+                                        mcc=random_text(rng), mnc=random_text(rng))
+            self.assertEqual(generate_capabilities(device, modem),
+                             render_elementtree(device, modem),
+                             (device, modem))
+
+    def test_offline_modem(self):
+        device = DeviceSnapshot('Vendor', 'Model', 'board', '1234', '1.0', '1.0')
+        modem = SimpleNamespace(network=None, mcc=None, mnc=None)
+        self.assertEqual(generate_capabilities(device, modem),
+                         render_elementtree(device, None))
+
+    @unittest.skipUnless(os.environ.get('OBEX_CAPABILITIES_BENCHMARK'),
+                         'set OBEX_CAPABILITIES_BENCHMARK=1 to run benchmarks')
+    def test_benchmark(self):
+        device = DeviceSnapshot('Fairphone', 'Fairphone 5', 'FP5', '490154203237518',
+                                '24.0', '24.0')
+        modem = SimpleNamespace(network='Orange F', mcc='208', mnc='01')
+
+        timings = {}
+        for name, render in (('ElementTree', render_elementtree),
+                             ('template', generate_capabilities)):
+            timer = Timer(lambda: render(device, modem))
+            number, _ = timer.autorange()
+            timings[name] = min(timer.repeat(5, number)) / number
+            print(f'\n{name}: {timings[name] * 1e6:.1f} us per render',
+                  end='', file=sys.stderr)
+
+        self.assertLess(timings['template'], timings['ElementTree'])
+
+if __name__ == '__main__':
+    unittest.main()
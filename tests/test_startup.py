@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ENTRY_POINT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'obex_capabilities', '__init__.py')
+# Modules a cached run must not pay for
+FORBIDDEN_MODULES = ['dbus', 'gi', 'argparse', 'logging', 'typing',
+                     'concurrent', 'threading', 're', 'enum', 'socket', 'json']
+# Cumulative import time of the package on a cached run, about 3 ms on a
+# laptop. Coarse so slow builders pass, FORBIDDEN_MODULES catches the
+# smaller regressions.
+IMPORT_BUDGET_US = 50000
+
+class StartupTest(unittest.TestCase):
+    """
+    Import time budget of the entry point obexd runs on every connection.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        root = self._dir.name
+
+        device_tree = os.path.join(root, 'device-tree')
+        os.mkdir(device_tree)
+        self.write('device-tree/compatible', 'vendor,board\0')
+        self.write('device-tree/model', 'Test Device\0')
+        self.write('os-release', 'ID=test\nVERSION_ID="1.0"\n')
+        self.write('machine-id', '0123456789abcdef0123456789abcdef\n')
+
+        self._env = dict(os.environ,
+                         HOME=root,
+                         XDG_STATE_HOME=os.path.join(root, 'state'),
+                         CACHE_DIR=os.path.join(root, 'runtime'),
+                         DEVICE_TREE_PATH=device_tree,
+                         PROPERTY_AREA_PATH=os.path.join(root, 'properties'),
+                         OS_RELEASE_PATH=os.path.join(root, 'os-release'),
+                         MACHINE_ID_PATH=os.path.join(root, 'machine-id'),
+                         OBEX_CAPABILITIES_CONFIG=os.path.join(root, 'config'),
+                         NETWORK_CACHE_TTL='3600')
+
+    def write(self, name: str, content: str):
+        with open(os.path.join(self._dir.name, name), 'w') as f:
+            f.write(content)
+
+    def run_entry_point(self, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, '-X', 'importtime', ENTRY_POINT, *args],
+                              env=self._env, capture_output=True, text=True,
+                              check=True)
+
+    def test_cached_run_imports(self):
+        # Fill the cache without touching D-Bus
+        self.write('config', 'BACKEND=none\n')
+        generated = self.run_entry_point()
+        self.assertIn('<Model>Test Device</Model>', generated.stdout)
+
+        cached = self.run_entry_point()
+        self.assertEqual(cached.stdout, generated.stdout)
+
+        imported = {}
+        for line in cached.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative)
+        self.assertIn('obex_capabilities', imported)
+        self.assertLess(imported['obex_capabilities'], IMPORT_BUDGET_US)
+        for module in FORBIDDEN_MODULES:
+            self.assertFalse({name for name in imported
+                              if name == module or name.startswith(f'{module}.')},
+                             f'{module} is imported on a cached run')
+
+if __name__ == '__main__':
+    unittest.main()